@@ -0,0 +1,77 @@
+# Compares the single-pass Plodine opening-hours extractor with the original
+# BeautifulSoup scan (get_text() on every div/table/ul/li/p/span/td) on saved
+# Plodine pages.
+#
+#   python bench/plodine_parse.py [pages...] [--repeat N]
+#
+# Without arguments every page in bench/fixtures/plodine/ is used.
+import os
+import re
+import sys
+import time
+from pathlib import Path
+
+from bs4 import BeautifulSoup
+
+BENCH_DIR = Path(__file__).parent
+sys.path.insert(0, str(BENCH_DIR.parent))
+os.environ.setdefault('SCHEDULER_ENABLED', '0')
+
+import main  # noqa: E402
+
+
+def find_plodine_sunday_soup(html):
+    # The extractor check_plodine used before the single-pass version
+    soup = BeautifulSoup(html, 'html.parser')
+    for tag in soup.find_all(['div', 'table', 'ul', 'li', 'p', 'span', 'td']):
+        text = tag.get_text(separator=' ', strip=True)
+        if 'Nedjelja' in text or 'nedjelja' in text or 'NEDJELJA' in text:
+            if 'Zatvoreno' in text or 'zatvoreno' in text or 'ZATVORENO' in text:
+                return False, 'Zatvoreno'
+            match = re.search(r'(\d{1,2}[:.]\d{2})\s*[-–—]\s*(\d{1,2}[:.]\d{2})', text)
+            if match:
+                from_time = match.group(1).replace('.', ':')
+                to_time = match.group(2).replace('.', ':')
+                return True, f'{from_time} - {to_time}'
+    return None
+
+
+def best_of(func, html, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(html)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def main_cli(argv):
+    repeat = 5
+    if '--repeat' in argv:
+        i = argv.index('--repeat')
+        repeat = int(argv[i + 1])
+        argv = argv[:i] + argv[i + 2:]
+    pages = [Path(p) for p in argv] or sorted((BENCH_DIR / 'fixtures' / 'plodine').glob('*.html'))
+    if not pages:
+        print("No Plodine pages found")
+        return 1
+
+    print(f"{'page':<28} {'size':>8} {'soup ms':>9} {'fast ms':>9} {'speedup':>8}  result")
+    failed = False
+    for page in pages:
+        html = page.read_text(encoding='utf-8')
+        soup_time, soup_result = best_of(find_plodine_sunday_soup, html, repeat)
+        fast_time, fast_result = best_of(main.find_plodine_sunday, html, repeat)
+        same = fast_result == soup_result
+        failed = failed or not same
+        print(
+            f"{page.name:<28} {len(html):>8} {soup_time * 1000:>9.1f} {fast_time * 1000:>9.1f} "
+            f"{soup_time / fast_time:>7.1f}x  {fast_result!r}{'' if same else f' != {soup_result!r}'}"
+        )
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli(sys.argv[1:]))
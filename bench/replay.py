@@ -0,0 +1,312 @@
+# Record/replay transport for main.http_session, so every checker can run
+# (and be timed) without touching the live sites.
+#
+#   python bench/replay.py record [--users josip,nina]
+#   python bench/replay.py serve [--port 8765] [--latency-ms N] [--jitter-ms N]
+#                                [--host-latency HOST=MS ...] [--fail-rate R]
+#                                [--fail-host HOST ...] [--seed N]
+#
+# `record` runs fetch_fresh_data for the users against the live sites and
+# saves every response. `serve` starts a local stand-in for the upstreams
+# that replays them with injected latency and 503s; point main at it with
+# install(server_adapter(url)).
+#
+# Recordings live in bench/fixtures/replay/index.json: "METHOD url" ->
+# status, headers and a body file relative to bench/fixtures/, plus a
+# "_capture" entry with the day they were recorded and the Sunday the
+# checkers were asked about, which the benchmarks pin. The checked-in
+# ones are synthetic responses shaped like the live ones (the Studenac and
+# Plodine pages are the parser fixtures); `record` replaces them.
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from datetime import date, datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, quote, urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.utils import get_encoding_from_headers
+
+BENCH_DIR = Path(__file__).parent
+FIXTURES_DIR = BENCH_DIR / 'fixtures'
+INDEX_PATH = FIXTURES_DIR / 'replay' / 'index.json'
+sys.path.insert(0, str(BENCH_DIR.parent))
+os.environ.setdefault('SCHEDULER_ENABLED', '0')
+# Keep benchmarks away from the app's cache DB and always download and parse
+os.environ.setdefault('CACHE_DB_PATH', '')
+os.environ.setdefault('CONDITIONAL_REQUESTS', '0')
+
+import main  # noqa: E402
+
+RECORDED_HEADERS = ('Content-Type', 'ETag', 'Last-Modified')
+CAPTURE_KEY = '_capture'
+
+
+def request_key(method, url):
+    return f"{method} {url}"
+
+
+def body_path(url, content_type):
+    parts = urlsplit(url)
+    name = Path(parts.path.strip('/').split('/')[-1]).stem
+    name = re.sub(r'[^A-Za-z0-9.-]+', '-', name).strip('-.')[:40] or 'index'
+    digest = hashlib.sha1(url.encode()).hexdigest()[:8]
+    ext = '.json' if 'json' in content_type else '.html' if 'html' in content_type else '.txt'
+    return f"replay/{parts.netloc}/{name}-{digest}{ext}"
+
+
+class Recordings:
+
+    def __init__(self, path=INDEX_PATH):
+        self.path = path
+        self.index = json.loads(path.read_text(encoding='utf-8')) if path.exists() else {}
+        self.capture = self.index.pop(CAPTURE_KEY, {})
+        self.bodies = {}
+        self.lock = threading.Lock()
+
+    def lookup(self, method, url):
+        # (status, headers, body) or None when the request was never recorded
+        entry = self.index.get(request_key(method, url))
+        if entry is None:
+            return None
+        rel = entry.get('body')
+        if rel and rel not in self.bodies:
+            self.bodies[rel] = (FIXTURES_DIR / rel).read_bytes()
+        return entry['status'], dict(entry['headers']), self.bodies.get(rel, b'')
+
+    def add(self, method, url, status, headers, body):
+        rel = body_path(url, headers.get('Content-Type', ''))
+        (FIXTURES_DIR / rel).parent.mkdir(parents=True, exist_ok=True)
+        (FIXTURES_DIR / rel).write_bytes(body)
+        with self.lock:
+            self.index[request_key(method, url)] = {
+                'status': status,
+                'headers': {name: headers[name] for name in RECORDED_HEADERS if name in headers},
+                'body': rel
+            }
+
+    def target_date(self):
+        # The date the recorded hours were fetched for; the recordings say nothing
+        # about any other
+        return date.fromisoformat(self.capture['target_date'])
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.lock:
+            index = dict(self.index, **{CAPTURE_KEY: self.capture})
+            self.path.write_text(json.dumps(index, indent=2, sort_keys=True) + '\n', encoding='utf-8')
+
+
+def not_modified(request_headers, headers):
+    etag = headers.get('ETag')
+    if etag and request_headers.get('If-None-Match') == etag:
+        return True
+    last_modified = headers.get('Last-Modified')
+    return bool(last_modified and request_headers.get('If-Modified-Since') == last_modified)
+
+
+def replay_response(request, status, headers, body):
+    if status == 200 and not_modified(request.headers, headers):
+        status, body = 304, b''
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers)
+    response.headers['Content-Length'] = str(len(body))
+    response.encoding = get_encoding_from_headers(response.headers)
+    # Read lazily so streaming parsers see the body chunk by chunk
+    response.raw = io.BytesIO(body)
+    response.url = request.url
+    response.request = request
+    return response
+
+
+class ReplayAdapter(HTTPAdapter):
+    # Answers from the recordings in-process; unknown requests get a 404
+
+    def __init__(self, recordings):
+        super().__init__()
+        self.recordings = recordings
+
+    def send(self, request, **kwargs):
+        found = self.recordings.lookup(request.method, request.url)
+        if found is None:
+            return replay_response(request, 404, {'Content-Type': 'text/plain'}, b'Not recorded')
+        return replay_response(request, *found)
+
+
+class RecordingAdapter(HTTPAdapter):
+    # Passes requests on to a real adapter and saves what comes back
+
+    def __init__(self, inner, recordings):
+        super().__init__()
+        self.inner = inner
+        self.recordings = recordings
+
+    def send(self, request, **kwargs):
+        response = self.inner.send(request, **kwargs)
+        if request.method == 'GET':
+            # Reads the whole body, even where a streaming parser would stop early
+            self.recordings.add(request.method, request.url, response.status_code, response.headers, response.content)
+        return response
+
+    def close(self):
+        self.inner.close()
+
+
+class ServerAdapter(HTTPAdapter):
+    # Sends every request to the stand-in server, original URL in the query
+
+    def __init__(self, base_url, **kwargs):
+        super().__init__(**kwargs)
+        self.base_url = base_url.rstrip('/')
+
+    def send(self, request, **kwargs):
+        request.url = f"{self.base_url}/replay?url={quote(request.url, safe='')}"
+        return super().send(request, **kwargs)
+
+
+def install(adapter):
+    # Routes every request main makes through adapter
+    for prefix in list(main.http_session.adapters):
+        main.http_session.mount(prefix, adapter)
+
+
+def server_adapter(base_url):
+    # Same pool size and retry policy as the app's own adapter
+    current = main.http_session.get_adapter('https://')
+    return ServerAdapter(base_url, pool_connections=main.HTTP_POOL_HOSTS, pool_maxsize=main.HTTP_POOL_SIZE,
+                         max_retries=current.max_retries)
+
+
+class ReplayServer(ThreadingHTTPServer):
+
+    def handle_error(self, request, client_address):
+        # Streaming parsers hang up as soon as they have what they need
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def make_server(recordings, port=0, latency_ms=0, jitter_ms=0, host_latency=None, fail_rate=0.0,
+                fail_hosts=(), seed=None):
+    rng = random.Random(seed)
+    host_latency = host_latency or {}
+    fail_hosts = set(fail_hosts)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            self.replay(send_body=True)
+
+        def do_HEAD(self):
+            self.replay(send_body=False)
+
+        def replay(self, send_body):
+            url = parse_qs(urlsplit(self.path).query).get('url', [''])[0]
+            host = urlsplit(url).netloc
+            delay = host_latency.get(host, latency_ms) + rng.uniform(0, jitter_ms)
+            if delay:
+                time.sleep(delay / 1000)
+
+            found = recordings.lookup('GET', url)
+            if host in fail_hosts or rng.random() < fail_rate:
+                status, headers, body = 503, {'Content-Type': 'text/plain'}, b'Injected failure'
+            elif found is None:
+                status, headers, body = 404, {'Content-Type': 'text/plain'}, b'Not recorded'
+            else:
+                status, headers, body = found
+                if status == 200 and not_modified(self.headers, headers):
+                    status, body = 304, b''
+
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if send_body:
+                self.wfile.write(body)
+
+    server = ReplayServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    return server
+
+
+def start_server(recordings, **kwargs):
+    # Serves in a daemon thread; returns (server, base URL)
+    server = make_server(recordings, **kwargs)
+    threading.Thread(target=server.serve_forever, name='replay-server', daemon=True).start()
+    host, port = server.server_address[:2]
+    return server, f"http://{host}:{port}"
+
+
+def pop_option(argv, name, default=None, many=False):
+    values = []
+    while name in argv:
+        i = argv.index(name)
+        values.append(argv[i + 1])
+        argv[i:i + 2] = []
+    if many:
+        return values
+    return values[-1] if values else default
+
+
+def record(argv):
+    users = pop_option(argv, '--users', ','.join(main.USER_STORES)).split(',')
+    recordings = Recordings()
+    install(RecordingAdapter(main.http_session.get_adapter('https://'), recordings))
+    target_date = main.get_next_sunday().date()
+    recordings.capture = {'date': datetime.now().date().isoformat(), 'target_date': target_date.isoformat()}
+    for user in users:
+        data = main.fetch_fresh_data(user, target_date=target_date)
+        print(f"{user}: {data['summary']}")
+    recordings.save()
+    print(f"{len(recordings.index)} responses in {recordings.path}")
+    return 0
+
+
+def serve(argv):
+    host_latency = {}
+    for value in pop_option(argv, '--host-latency', many=True):
+        host, ms = value.split('=')
+        host_latency[host] = float(ms)
+    seed = pop_option(argv, '--seed')
+    server = make_server(
+        Recordings(),
+        port=int(pop_option(argv, '--port', '8765')),
+        latency_ms=float(pop_option(argv, '--latency-ms', '0')),
+        jitter_ms=float(pop_option(argv, '--jitter-ms', '0')),
+        host_latency=host_latency,
+        fail_rate=float(pop_option(argv, '--fail-rate', '0')),
+        fail_hosts=pop_option(argv, '--fail-host', many=True),
+        seed=int(seed) if seed is not None else None
+    )
+    host, port = server.server_address[:2]
+    print(f"Replaying {INDEX_PATH} on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def main_cli(argv):
+    argv = list(argv)
+    if not argv or argv[0] not in ('record', 'serve'):
+        print("usage: replay.py record|serve [options]")
+        return 1
+    return record(argv[1:]) if argv[0] == 'record' else serve(argv[1:])
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli(sys.argv[1:]))
@@ -0,0 +1,57 @@
+# Compares the fast Studenac work-hours extractor with the BeautifulSoup path
+# on saved store pages.
+#
+#   python bench/studenac_parse.py [pages...] [--repeat N]
+#
+# Without arguments every page in bench/fixtures/studenac/ is used.
+import os
+import sys
+import time
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).parent
+sys.path.insert(0, str(BENCH_DIR.parent))
+os.environ.setdefault('SCHEDULER_ENABLED', '0')
+
+import main  # noqa: E402
+
+
+def best_of(func, html, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(html)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def main_cli(argv):
+    repeat = 20
+    if '--repeat' in argv:
+        i = argv.index('--repeat')
+        repeat = int(argv[i + 1])
+        argv = argv[:i] + argv[i + 2:]
+    pages = [Path(p) for p in argv] or sorted((BENCH_DIR / 'fixtures' / 'studenac').glob('*.html'))
+    if not pages:
+        print("No Studenac pages found")
+        return 1
+
+    print(f"{'page':<24} {'size':>8} {'soup ms':>9} {'fast ms':>9} {'speedup':>8}  result")
+    failed = False
+    for page in pages:
+        html = page.read_text(encoding='utf-8')
+        soup_time, soup_result = best_of(main.find_studenac_sunday_soup, html, repeat)
+        fast_time, fast_result = best_of(main.find_studenac_sunday_fast, html, repeat)
+        same = fast_result == soup_result
+        failed = failed or not same
+        print(
+            f"{page.name:<24} {len(html):>8} {soup_time * 1000:>9.3f} {fast_time * 1000:>9.3f} "
+            f"{soup_time / fast_time:>7.1f}x  {fast_result!r}{'' if same else f' != {soup_result!r}'}"
+        )
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli(sys.argv[1:]))
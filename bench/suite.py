@@ -0,0 +1,161 @@
+# Offline benchmarks for the checkers, replayed from bench/fixtures/replay/
+# (see bench/replay.py).
+#
+#   python bench/suite.py [--repeat N] [--latency-ms N] [--jitter-ms N]
+#                         [--fail-rate R] [--json PATH]
+#
+# Per chain: best-of-N time for the checker to fetch (in-process, from
+# memory) and parse every distinct store, and the peak memory it allocates
+# doing so. Then end-to-end fetch_fresh_data for each user, and one batch for
+# all of them, through the local stand-in server with the given injected
+# latency and failures. --json writes the numbers for tracking over time.
+#
+# Every run asks for the Sunday the fixtures were recorded for, with
+# get_next_sunday() pinned to it, so the results don't change with the day
+# the suite is run on.
+import json
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime, time as dt_time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+# The checkers log every failure, injected ones included; keep the report readable
+os.environ.setdefault('LOG_LEVEL', 'CRITICAL')
+
+import replay  # noqa: E402
+from replay import main, pop_option  # noqa: E402
+
+NO_DATA_HOURS = ('Nema podataka', 'Podaci nedostupni')
+
+
+def pin_target_date(recordings):
+    target_date = recordings.target_date()
+    # Konzum only answers for "the coming Sunday"
+    main.get_next_sunday = lambda: datetime.combine(target_date, dt_time.min)
+    return target_date
+
+
+def reset_sources():
+    with main.source_cache_lock:
+        main.source_cache.clear()
+        main.source_indexes.clear()
+    # Every run starts with closed breakers and nothing to fall back on
+    with main.breaker_lock:
+        main.breakers.clear()
+    with main.last_good_lock:
+        main.last_good.clear()
+
+
+def best_of(func, args, repeat, **kwargs):
+    best = None
+    for _ in range(repeat):
+        reset_sources()
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def peak_memory(func, args, **kwargs):
+    reset_sources()
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def failed(rows):
+    return sum(1 for row in rows if main.is_failed_row(row) or 'stale_since' in row)
+
+
+def no_data(rows):
+    # The fixtures had nothing for the date; a timing that parsed nothing
+    return sum(1 for row in rows if row['hours'] in NO_DATA_HOURS)
+
+
+def warn_no_data(report, target_date):
+    missing = sum(entry['no_data'] for entry in report.values())
+    if missing:
+        print(f"warning: {missing} rows have no data for {target_date}; re-record the fixtures")
+
+
+def bench_checkers(repeat, recordings, target_date):
+    replay.install(replay.ReplayAdapter(recordings))
+    stores_config, _ = main.plan_batch(list(main.USER_STORES))
+    report = {}
+    print(f"{'chain':<10} {'stores':>6} {'ms':>9} {'peak KiB':>9} {'errors':>7} {'no data':>7}")
+    for key, checker, label, _ in main.CHECKERS:
+        config = {key: stores_config.get(key, [])}
+        if not config[key]:
+            continue
+        elapsed, rows = best_of(checker, (config, target_date), repeat)
+        peak = peak_memory(checker, (config, target_date))
+        report[key] = {'stores': len(config[key]), 'ms': elapsed * 1000, 'peak_kib': peak / 1024,
+                       'errors': failed(rows), 'no_data': no_data(rows)}
+        print(f"{label:<10} {len(config[key]):>6} {elapsed * 1000:>9.2f} {peak / 1024:>9.0f} {failed(rows):>7} "
+              f"{no_data(rows):>7}")
+    warn_no_data(report, target_date)
+    return report
+
+
+def bench_end_to_end(repeat, recordings, target_date, **server_options):
+    server, url = replay.start_server(recordings, seed=1, **server_options)
+    replay.install(replay.server_adapter(url))
+    users = list(main.USER_STORES)
+    report = {}
+    print(f"\n{'fetch':<24} {'stores':>6} {'ms':>9} {'errors':>7} {'no data':>7}")
+    try:
+        runs = [(user, main.fetch_fresh_data, (user,)) for user in users]
+        runs.append(('batch: ' + ','.join(users), main.fetch_fresh_batch, (users,)))
+        for name, func, args in runs:
+            elapsed, result = best_of(func, args, repeat, target_date=target_date)
+            if func is main.fetch_fresh_batch:
+                rows = [row for data in result.values() for row in data['stores']]
+            else:
+                rows = result['stores']
+            report[name] = {'stores': len(rows), 'ms': elapsed * 1000, 'errors': failed(rows), 'no_data': no_data(rows)}
+            print(f"{name:<24} {len(rows):>6} {elapsed * 1000:>9.1f} {failed(rows):>7} {no_data(rows):>7}")
+    finally:
+        server.shutdown()
+        server.server_close()
+    warn_no_data(report, target_date)
+    return report
+
+
+def main_cli(argv):
+    argv = list(argv)
+    repeat = int(pop_option(argv, '--repeat', '5'))
+    json_path = pop_option(argv, '--json')
+    server_options = {
+        'latency_ms': float(pop_option(argv, '--latency-ms', '0')),
+        'jitter_ms': float(pop_option(argv, '--jitter-ms', '0')),
+        'fail_rate': float(pop_option(argv, '--fail-rate', '0'))
+    }
+    if argv:
+        print(f"Unknown arguments: {' '.join(argv)}")
+        return 1
+
+    recordings = replay.Recordings()
+    target_date = pin_target_date(recordings)
+    report = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'target_date': target_date.isoformat(),
+        'repeat': repeat,
+        'server': server_options,
+        'checkers': bench_checkers(repeat, recordings, target_date),
+        'end_to_end': bench_end_to_end(repeat, recordings, target_date, **server_options)
+    }
+    if json_path:
+        Path(json_path).write_text(json.dumps(report, indent=2) + '\n', encoding='utf-8')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli(sys.argv[1:]))
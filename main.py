@@ -1,101 +1,756 @@
-from flask import Flask, jsonify, render_template_string, send_from_directory, request
+from flask import Flask, jsonify, send_file, send_from_directory, request, Response, stream_with_context
 import requests
-from datetime import datetime, timedelta
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from datetime import datetime, timedelta, time as dt_time
+from collections import OrderedDict, deque
 import json
-from threading import Lock
+import codecs
+import hashlib
+import gzip
+from threading import Lock, local
+from concurrent.futures import ThreadPoolExecutor, Future, wait, TimeoutError as FutureTimeout
+from contextvars import ContextVar, copy_context
+from urllib.parse import urlencode, urlsplit
 from bs4 import BeautifulSoup
+from html import unescape as html_unescape
 import os
-from pathlib import Path
+from pathlib import Path, PurePosixPath
+import mimetypes
+import shutil
 import re
+import time
+import tempfile
+import sqlite3
+from threading import Thread
+from queue import Queue, SimpleQueue
+import copy
+import logging
+import logging.handlers
+import sys
+import atexit
 
 HEADERS = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
 }
 
-app = Flask(__name__, static_folder='static', static_url_path='/static')
-
-@app.route('/static/<path:filename>')
-def serve_static(filename):
-    return send_from_directory('static', filename)
+try:
+    # Lets urllib3 decode br responses and /api/check send them
+    import brotli
+    ACCEPT_ENCODING = 'gzip, deflate, br'
+except ImportError:
+    brotli = None
+    ACCEPT_ENCODING = 'gzip, deflate'
+
+# DEBUG turns on the per-step checker logs; 'json' or 'text' (key=value) lines
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+# A repeated failure (same chain and error type) logs its traceback at most this often
+LOG_TRACEBACK_INTERVAL_SECONDS = int(os.environ.get('LOG_TRACEBACK_INTERVAL_SECONDS', '300'))
+
+log = logging.getLogger('trgovine')
+log_lock = Lock()
+traceback_last = {}
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    # The stock prepare() flattens fields and traceback into the message;
+    # keep them apart for the formatter on the listener side
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class FieldsFormatter(logging.Formatter):
+
+    def format(self, record):
+        fields = getattr(record, 'fields', None) or {}
+        if LOG_FORMAT == 'json':
+            entry = {
+                'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+                'level': record.levelname,
+                'message': record.getMessage()
+            }
+            entry.update(fields)
+            if record.exc_text:
+                entry['traceback'] = record.exc_text
+            return json.dumps(entry, ensure_ascii=False, default=str)
+        line = f"{self.formatTime(record, '%Y-%m-%d %H:%M:%S')} {record.levelname} {record.getMessage()}"
+        for key, value in fields.items():
+            value = str(value)
+            line += f" {key}={json.dumps(value, ensure_ascii=False) if ' ' in value or not value else value}"
+        if record.exc_text:
+            line += '\n' + record.exc_text
+        return line
+
+
+def setup_logging():
+    # Request and fetch threads only put records on a queue; one listener
+    # thread does the writing
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(FieldsFormatter())
+    queue = SimpleQueue()
+    listener = logging.handlers.QueueListener(queue, handler)
+    log.addHandler(LogQueueHandler(queue))
+    log.setLevel(LOG_LEVEL)
+    log.propagate = False
+    listener.start()
+    atexit.register(listener.stop)
+
+
+def log_event(level, message, **fields):
+    if log.isEnabledFor(level):
+        log.log(level, message, extra={'fields': fields})
+
+
+def log_error(message, error, level=logging.ERROR, **fields):
+    # Always logs the error; the traceback only once per interval for the
+    # same chain and error type, with a count of the ones skipped since
+    key = (fields.get('chain'), type(error).__name__)
+    now = time.monotonic()
+    with log_lock:
+        last, suppressed = traceback_last.get(key, (None, 0))
+        show = last is None or now - last >= LOG_TRACEBACK_INTERVAL_SECONDS
+        traceback_last[key] = (now, 0) if show else (last, suppressed + 1)
+    if show and suppressed:
+        fields['tracebacks_suppressed'] = suppressed
+    fields['error'] = str(error)
+    log.log(level, message, exc_info=error if show else None, extra={'fields': fields})
+
+
+setup_logging()
+
+# Static files are served by serve_static, which Flask's own static route would shadow
+app = Flask(__name__, static_folder=None)
 
 BASE_DIR = Path(__file__).parent
+STATIC_DIR = BASE_DIR / 'static'
+# `flask --app main build-assets` writes content-hashed copies of the static
+# files, their .br/.gz variants and manifest.json here
+ASSET_BUILD_DIR = STATIC_DIR / 'build'
+ASSET_MAX_AGE = 365 * 24 * 3600
+ASSET_ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
 
-def static_version() -> str:
-    static_dir = BASE_DIR / "static"
-    if not static_dir.exists():
-        return "1"
-    latest = 0
-    for root, _, files in os.walk(static_dir):
-        for f in files:
-            path = Path(root) / f
-            try:
-                mtime = int(path.stat().st_mtime)
-                if mtime > latest:
-                    latest = mtime
-            except OSError:
+
+def hashed_name(name, content):
+    path = PurePosixPath(name)
+    return str(path.with_name(f"{path.stem}.{hashlib.sha256(content).hexdigest()[:12]}{path.suffix}"))
+
+
+def load_asset_manifest():
+    # name -> {'hashed', 'encodings', 'built'}; only the built manifest is
+    # read at startup, never the static directory
+    try:
+        manifest = json.loads((ASSET_BUILD_DIR / 'manifest.json').read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        return {}
+    return {name: dict(entry, built=True) for name, entry in manifest.items()}
+
+
+asset_manifest = load_asset_manifest()
+# hashed name -> name
+asset_sources = {entry['hashed']: name for name, entry in asset_manifest.items()}
+asset_lock = Lock()
+
+
+def asset_url(name):
+    entry = asset_manifest.get(name)
+    if entry is None:
+        # Not built (development): hash just this file and serve it as is
+        entry = {'hashed': hashed_name(name, (STATIC_DIR / name).read_bytes()), 'encodings': [], 'built': False}
+        with asset_lock:
+            asset_manifest[name] = entry
+            asset_sources[entry['hashed']] = name
+    return '/static/' + entry['hashed']
+
+
+def build_assets():
+    shutil.rmtree(ASSET_BUILD_DIR, ignore_errors=True)
+    manifest = {}
+    for path in sorted(STATIC_DIR.rglob('*')):
+        if not path.is_file():
+            continue
+        name = path.relative_to(STATIC_DIR).as_posix()
+        content = path.read_bytes()
+        entry = {'hashed': hashed_name(name, content), 'encodings': []}
+        target = ASSET_BUILD_DIR / entry['hashed']
+        target.parent.mkdir(parents=True, exist_ok=True)
+        target.write_bytes(content)
+        for encoding, suffix in ASSET_ENCODINGS:
+            if encoding == 'br' and brotli is None:
                 continue
-    return str(latest or 1)
+            if encoding == 'br':
+                compressed = brotli.compress(content, quality=11)
+            else:
+                compressed = gzip.compress(content, compresslevel=9, mtime=0)
+            if len(compressed) < len(content):
+                target.with_name(target.name + suffix).write_bytes(compressed)
+                entry['encodings'].append(encoding)
+        manifest[name] = entry
+    (ASSET_BUILD_DIR / 'manifest.json').write_text(json.dumps(manifest, indent=2, sort_keys=True) + '\n', encoding='utf-8')
+    return manifest
+
 
-STATIC_VERSION = static_version()
+@app.cli.command('build-assets')
+def build_assets_command():
+    for name, entry in build_assets().items():
+        print(f"{name} -> {entry['hashed']} {' '.join(entry['encodings'])}")
 
-cache = {'data': None, 'timestamp': None, 'date': None, 'user': None}
+
+@app.route('/static/<path:filename>')
+def serve_static(filename):
+    name = asset_sources.get(filename)
+    if name is None:
+        # Unhashed URL, e.g. from a page cached before a deploy
+        return send_from_directory(STATIC_DIR, filename)
+
+    entry = asset_manifest[name]
+    mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    if not entry['built']:
+        response = send_from_directory(STATIC_DIR, name, mimetype=mimetype, max_age=ASSET_MAX_AGE)
+    else:
+        path = ASSET_BUILD_DIR / entry['hashed']
+        encoding = next((encoding for encoding, _ in ASSET_ENCODINGS
+                         if encoding in entry['encodings'] and request.accept_encodings[encoding] > 0), None)
+        if encoding:
+            path = path.with_name(path.name + dict(ASSET_ENCODINGS)[encoding])
+        response = send_file(path, mimetype=mimetype, max_age=ASSET_MAX_AGE)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.headers['Vary'] = 'Accept-Encoding'
+    # The content can never change under this URL, so browsers never revalidate
+    response.headers['Cache-Control'] = f'public, max-age={ASSET_MAX_AGE}, immutable'
+    return response
+
+# (user, target sunday) -> {'data', 'timestamp', 'date', 'expires'}, oldest first
+cache = OrderedDict()
 cache_lock = Lock()
+cache_stats = {'hits': 0, 'misses': 0, 'stale': 0, 'coalesced': 0, 'evictions': 0}
 CACHE_DURATION_HOURS = 6
+# How long past expiry an entry may still be served while a refresh runs
+CACHE_STALE_HOURS = float(os.environ.get('CACHE_STALE_HOURS', '24'))
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', '32'))
+# /api/check bodies at least this big are sent compressed when the client accepts it
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', '512'))
+
+# Results are also persisted here so every gunicorn worker and every restart
+# can serve the last good result. Set to an empty string to disable.
+CACHE_DB_PATH = os.environ.get('CACHE_DB_PATH', os.path.join(tempfile.gettempdir(), 'trgovine-cache.sqlite3'))
+cache_db_local = local()
+cache_db_lock = Lock()
+# pid of the process that has set up the schema
+cache_db_ready = None
+# A worker refreshing a key holds a lease on it for at most this long
+REFRESH_LEASE_SECONDS = int(os.environ.get('REFRESH_LEASE_SECONDS', '120'))
+
+# Parsed upstream documents (Spar store list, Konzum locations, Lidl payloads...)
+# shared by every user's refresh
+source_cache = {}
+source_cache_lock = Lock()
+source_locks = {}
+# key -> (payload, index built from it) for bulk store lists
+source_indexes = {}
+SOURCE_CACHE_TTL_MINUTES = int(os.environ.get('SOURCE_CACHE_TTL_MINUTES', '30'))
+# Revalidate expired documents with If-None-Match/If-Modified-Since instead of
+# downloading them again
+CONDITIONAL_REQUESTS = os.environ.get('CONDITIONAL_REQUESTS', '1') == '1'
+source_stats = {'requests': 0, 'not_modified': 0, 'unchanged': 0, 'bytes_received': 0, 'bytes_saved': 0}
+# Parse the big Spar list and Lidl payloads incrementally and stop reading once
+# everything we need has arrived
+STREAM_PARSE = os.environ.get('STREAM_PARSE', '1') == '1'
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Endpoints served from source_cache during the refresh running in this context
+source_cache_trace = ContextVar('source_cache_trace', default=None)
+
+# Prometheus metrics served on /metrics, per process.
+# name -> (help, buckets) for histograms, name -> help for counters
+METRIC_HISTOGRAMS = {
+    'trgovine_upstream_request_seconds': (
+        'Upstream request time until the response headers (the whole body unless streamed)',
+        (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25)
+    ),
+    'trgovine_checker_seconds': ('Wall time of one checker task', (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25)),
+    'trgovine_checker_parse_seconds': (
+        'Checker time outside upstream requests: parsing, including streamed body reads',
+        (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+    ),
+    'trgovine_refresh_seconds': ('Duration of a fetch_fresh_data refresh batch', (0.5, 1, 2.5, 5, 10, 15, 20, 30, 60))
+}
+METRIC_COUNTERS = {
+    'trgovine_upstream_timeouts_total': 'Upstream requests that timed out',
+    'trgovine_upstream_errors_total': 'Upstream requests that failed or returned an error status',
+    'trgovine_fetch_deadline_exceeded_total': 'Checker tasks cut off by FETCH_DEADLINE_SECONDS',
+    'trgovine_upstream_short_circuited_total': 'Upstream requests skipped because the host circuit breaker was open',
+    'trgovine_stale_rows_total': 'Store rows filled from the last good result after a failed check'
+}
+metrics = {}
+metrics_lock = Lock()
+# {'chain': config key, 'network': seconds in upstream requests} for the checker task running in this context
+metrics_scope = ContextVar('metrics_scope', default=None)
+
+# 'parallel' fans every (chain, store) fetch out on a shared worker pool,
+# 'sequential' keeps the old one-checker-after-another behaviour
+FETCH_MODE = os.environ.get('FETCH_MODE', 'parallel')
+FETCH_WORKERS = int(os.environ.get('FETCH_WORKERS', '12'))
+FETCH_DEADLINE_SECONDS = float(os.environ.get('FETCH_DEADLINE_SECONDS', '25'))
+# Upper bound for /api/check?budget_ms=; a refresh still running when the
+# budget runs out is answered with the rows it has so far
+CHECK_BUDGET_MAX_MS = int(os.environ.get('CHECK_BUDGET_MAX_MS', '30000'))
+# How soon a client should ask again for the rest of a partial result
+PARTIAL_RETRY_MS = int(os.environ.get('PARTIAL_RETRY_MS', '1000'))
+SCHEDULER_ENABLED = os.environ.get('SCHEDULER_ENABLED', '1') == '1'
+SCHEDULE_INTERVAL_MINUTES = int(os.environ.get('SCHEDULE_INTERVAL_MINUTES', '60'))
+# Saturday and Sunday mornings are when people check, so refresh more often then
+SCHEDULE_PEAK_INTERVAL_MINUTES = int(os.environ.get('SCHEDULE_PEAK_INTERVAL_MINUTES', '15'))
+SCHEDULE_PEAK_HOURS = (6, 13)
+SCHEDULE_CHAIN_STAGGER_SECONDS = float(os.environ.get('SCHEDULE_CHAIN_STAGGER_SECONDS', '1.5'))
+SCHEDULER_LOCK_PATH = os.environ.get(
+    'SCHEDULER_LOCK_PATH',
+    os.path.join(tempfile.gettempdir(), 'trgovine-scheduler.lock')
+)
+
+# Parallel fetches per chain, overridable as FETCH_CONCURRENCY_<CHAIN>
+CHAIN_CONCURRENCY = {
+    key: int(os.environ.get(f'FETCH_CONCURRENCY_{key.upper()}', default))
+    for key, default in (
+        ('spar', 1),
+        ('lidl', 2),
+        ('konzum', 1),
+        ('kaufland', 2),
+        ('studenac', 3),
+        ('dm', 2),
+        ('muller', 2),
+        ('plodine', 1)
+    )
+}
 
-JOSIP_STORES = {
-    'spar': [
-        {'id': 38, 'name': 'SPAR Gospodska'},
-        {'id': 7,  'name': 'SPAR King Cross'},
-        {'id': 2,  'name': 'City Center West'}
-    ],
-    'lidl': [
-    {'url': 'https://www.lidl.hr/s/hr-HR/trazilica-trgovina/zagreb/huzjanova-ulica-4/', 'name': 'Lidl Huzjanova'}
-    ],
-    'konzum': [
-        {'id': 48,  'name': 'Konzum Bolnička'},
-        {'id': 216, 'name': 'Konzum Huzjanova'}
-    ],
-    'kaufland': [
-        {'id': 'HR5630', 'name': 'Kaufland Jankomir'}
-    ],
-    'studenac': [
-        {
-            'name': 'Studenac Gospodska',
-            'url': 'https://www.studenac.hr/trgovine/1578/t1715-zagreb'
-        },
-        {
-            'name': 'Studenac Dudovec',
-            'url': 'https://www.studenac.hr/trgovine/1507/t1568-zagreb'
-        },
-        {
-            'name': 'Studenac Bolnička',
-            'url': 'https://www.studenac.hr/trgovine/1543/t1687-zagreb'
-        }
-    ]
+HTTP_POOL_HOSTS = int(os.environ.get('HTTP_POOL_HOSTS', '16'))
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', '4'))
+HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', '2'))
+HTTP_BACKOFF = float(os.environ.get('HTTP_BACKOFF', '0.3'))
+# Per upstream host: after this many failures in a row stop calling it for
+# BREAKER_RESET_SECONDS, then let a single request through to probe it
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', '3'))
+BREAKER_RESET_SECONDS = float(os.environ.get('BREAKER_RESET_SECONDS', '60'))
+# host -> {'state': 'closed'|'open'|'half_open', 'failures', 'opened_at', 'short_circuited'}
+breakers = {}
+breaker_lock = Lock()
+# Results with rows filled from an older result are kept this long, so a
+# recovered upstream shows up without waiting CACHE_DURATION_HOURS
+DEGRADED_CACHE_MINUTES = int(os.environ.get('DEGRADED_CACHE_MINUTES', '10'))
+
+# Origin -> verify TLS. Used to open keep-alive connections ahead of a refresh.
+UPSTREAM_ORIGINS = {
+    'https://www.spar.hr': True,
+    'https://trgovine.konzum.hr': True,
+    'https://www.kaufland.hr': True,
+    'https://www.lidl.hr': True,
+    'https://www.studenac.hr': True,
+    'https://store-data-service.services.dmtech.com': True,
+    'https://backend.prod.ecom.mueller.hr': True,
+    'https://www.plodine.hr': False
 }
 
-NINA_STORES = {
-    'lidl': [
-    {'url': 'https://www.lidl.hr/s/hr-HR/trazilica-trgovina/zapresic/ulica-kardinala-alojzija-stepinca-64/', 'name': 'Lidl Zaprešić'}
-    ],
-    'konzum': [
-        {'id': 200, 'name': 'Konzum Šibice'}
-    ],
-    'dm': [
-        {'storeId': 'K095', 'name': 'DM Zaprešić'}
-    ],
-    'muller': [
-            {'storeId': '5089', 'name': 'Müller Zaprešić'}
-    ],
-    'plodine': [
-        {
-            'name': 'Plodine Zaprešić',
-            'url': 'https://www.plodine.hr/supermarketi/90/hipermarket-zapresic?select=90'
+def build_http_session():
+    # Retries connect errors and 429/5xx answers only: a read timeout is the
+    # request's own timeout running out, so it is raised as Timeout right away
+    retry = Retry(
+        total=HTTP_RETRIES,
+        read=False,
+        backoff_factor=HTTP_BACKOFF,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(['GET', 'HEAD']),
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['Accept-Encoding'] = ACCEPT_ENCODING
+    return session
+
+http_session = build_http_session()
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    pass
+
+
+def breaker_allow(host):
+    # Raises CircuitOpenError while the host's breaker is open. Once
+    # BREAKER_RESET_SECONDS have passed the first caller becomes the probe.
+    with breaker_lock:
+        breaker = breakers.setdefault(host, {'state': 'closed', 'failures': 0, 'opened_at': None, 'short_circuited': 0})
+        if breaker['state'] == 'closed':
+            return
+        now = time.monotonic()
+        # A probe that never reported back gets replaced after another interval
+        if now - breaker['opened_at'] >= BREAKER_RESET_SECONDS:
+            breaker.update(state='half_open', opened_at=now)
+            return
+        breaker['short_circuited'] += 1
+    count_metric('trgovine_upstream_short_circuited_total', host=host)
+    raise CircuitOpenError(f'{host} is failing, not calling it for now')
+
+
+def breaker_record(host, ok):
+    with breaker_lock:
+        breaker = breakers[host]
+        previous = breaker['state']
+        if ok:
+            breaker.update(state='closed', failures=0, opened_at=None)
+        else:
+            breaker['failures'] += 1
+            if previous == 'half_open' or breaker['failures'] >= BREAKER_FAILURE_THRESHOLD:
+                breaker.update(state='open', opened_at=time.monotonic())
+        state = breaker['state']
+        failures = breaker['failures']
+    if state != previous:
+        level = logging.INFO if state == 'closed' else logging.WARNING
+        log_event(level, "Circuit breaker " + state, host=host, failures=failures)
+
+
+def breaker_info():
+    now = time.monotonic()
+    with breaker_lock:
+        return {
+            host: {
+                'state': breaker['state'],
+                'failures': breaker['failures'],
+                'short_circuited': breaker['short_circuited'],
+                'retry_in_s': round(max(BREAKER_RESET_SECONDS - (now - breaker['opened_at']), 0), 1)
+                if breaker['state'] == 'open' else None
+            }
+            for host, breaker in breakers.items()
         }
-    ]
-}
 
 
+def http_get(url, **kwargs):
+    scope = metrics_scope.get()
+    labels = {'chain': scope['chain'] if scope else '', 'host': urlsplit(url).netloc}
+    breaker_allow(labels['host'])
+    start = time.perf_counter()
+    try:
+        response = http_session.get(url, **kwargs)
+    except requests.exceptions.Timeout:
+        breaker_record(labels['host'], False)
+        count_metric('trgovine_upstream_timeouts_total', **labels)
+        raise
+    except requests.exceptions.RequestException as e:
+        breaker_record(labels['host'], False)
+        count_metric('trgovine_upstream_errors_total', kind=type(e).__name__, **labels)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        observe_metric('trgovine_upstream_request_seconds', elapsed, **labels)
+        if scope is not None:
+            scope['network'] += elapsed
+    # A 404 is the site answering; 5xx and 429 (after retries) mean it is struggling
+    breaker_record(labels['host'], response.status_code < 500 and response.status_code != 429)
+    if response.status_code >= 400:
+        count_metric('trgovine_upstream_errors_total', kind=f'http_{response.status_code}', **labels)
+    log_event(logging.DEBUG, "Upstream request", status=response.status_code, duration_ms=round(elapsed * 1000), **labels)
+    return response
+
+
+def metric_labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def observe_metric(name, value, **labels):
+    buckets = METRIC_HISTOGRAMS[name][1]
+    with metrics_lock:
+        series = metrics.setdefault((name, metric_labels(labels)), {'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0})
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                series['buckets'][i] += 1
+        series['sum'] += value
+        series['count'] += 1
+
+
+def count_metric(name, amount=1, **labels):
+    with metrics_lock:
+        key = (name, metric_labels(labels))
+        metrics[key] = metrics.get(key, 0) + amount
+
+
+def warm_up_connections():
+    def warm(origin, verify):
+        try:
+            http_session.head(origin + '/', timeout=5, verify=verify, allow_redirects=False, headers=HEADERS)
+        except Exception as e:
+            log_event(logging.DEBUG, "Warm-up failed", host=origin, error=e)
+
+    futures = [fetch_executor.submit(warm, origin, verify) for origin, verify in UPSTREAM_ORIGINS.items()]
+    wait(futures, timeout=10)
+
+
+def http_pool_stats():
+    stats = {}
+    for adapter in set(http_session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            host = stats.setdefault(pool.host, {'requests': 0, 'connections': 0, 'reused': 0})
+            host['requests'] += pool.num_requests
+            host['connections'] += pool.num_connections
+            host['reused'] = max(host['requests'] - host['connections'], 0)
+    return stats
+
+
+def parse_json(response):
+    return response.json()
+
+
+def parse_text(response):
+    return response.text
+
+
+def source_key(url, params=None, variant=None):
+    key = url
+    if params:
+        key += '?' + urlencode(sorted(params.items()))
+    if variant:
+        key += '#' + variant
+    return key
+
+
+def response_size(response, body=None):
+    # Bytes on the wire when the server says, else what we read
+    length = response.headers.get('Content-Length', '')
+    if length.isdigit():
+        return int(length)
+    return len(body) if body is not None else 0
+
+
+def conditional_headers(entry, headers=None):
+    headers = dict(headers or {})
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+
+def fetch_source(url, parse=parse_json, params=None, variant=None, **kwargs):
+    # variant tells apart documents parsed differently from the same URL
+    key = source_key(url, params, variant)
+    with source_cache_lock:
+        lock = source_locks.setdefault(key, Lock())
+
+    # Per-endpoint lock so two users refreshing at once download a shared list only once
+    with lock:
+        now = datetime.now()
+        entry = source_cache.get(key)
+        if entry and (now - entry['timestamp']).total_seconds() < SOURCE_CACHE_TTL_MINUTES * 60:
+            trace = source_cache_trace.get()
+            if trace is not None:
+                trace.append(key)
+            return entry['data']
+
+        if entry is None and CONDITIONAL_REQUESTS:
+            entry = source_validators_load(key)
+        if entry and CONDITIONAL_REQUESTS:
+            kwargs['headers'] = conditional_headers(entry, kwargs.get('headers'))
+
+        response = http_get(url, params=params, **kwargs)
+        try:
+            response.raise_for_status()
+            if response.status_code == 304 and entry:
+                with source_cache_lock:
+                    source_stats['requests'] += 1
+                    source_stats['not_modified'] += 1
+                    source_stats['bytes_saved'] += entry.get('size') or 0
+                    entry['timestamp'] = now
+                    source_cache[key] = entry
+                return entry['data']
+
+            digest = None
+            body = None
+            if not kwargs.get('stream'):
+                # No validators to go by: a body identical to the last one
+                # still skips the parse and keeps indexes built from it
+                body = response.content
+                digest = hashlib.sha1(body).hexdigest()
+            if entry and digest and entry.get('hash') == digest:
+                data = entry['data']
+                unchanged = 1
+            else:
+                data = parse(response)
+                unchanged = 0
+            size = response_size(response, body)
+        finally:
+            # Streaming parsers may stop early; this drops the unread rest
+            response.close()
+        fresh = {
+            'data': data,
+            'timestamp': now,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'hash': digest,
+            'size': size
+        }
+        with source_cache_lock:
+            source_stats['requests'] += 1
+            source_stats['unchanged'] += unchanged
+            source_stats['bytes_received'] += size
+            source_cache[key] = fresh
+        if CONDITIONAL_REQUESTS and not unchanged and (fresh['etag'] or fresh['last_modified'] or digest):
+            source_validators_store(key, fresh)
+        return data
+
+
+def iter_json_array(response):
+    # Yields the elements of a top-level JSON array as the body arrives
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder(response.encoding or 'utf-8')(errors='replace')
+    buf = ''
+    pos = 0
+    started = False
+    chunks = response.iter_content(chunk_size=STREAM_CHUNK_SIZE)
+    finished = False
+    while not finished:
+        chunk = next(chunks, None)
+        if chunk is None:
+            finished = True
+            buf = buf[pos:] + text.decode(b'', final=True)
+        else:
+            buf = buf[pos:] + text.decode(chunk)
+        pos = 0
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos >= len(buf):
+                break
+            if not started:
+                if buf[pos] != '[':
+                    raise ValueError('Expected a JSON array')
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == ']':
+                return
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if finished:
+                    raise
+                break
+            # A bare number cut at a chunk boundary may continue in the next chunk
+            if not finished and not isinstance(value, (dict, list, str)) and (end == len(buf) or buf[end] not in ' \t\r\n,]'):
+                break
+            yield value
+            pos = end
+    if not started:
+        raise ValueError('Empty JSON body')
+
+
+def parse_spar_stream(targets):
+    # Keeps only the store records for the locationIds in targets
+    def parse(response):
+        wanted = set(targets)
+        stores = []
+        for store in iter_json_array(response):
+            loc_id = str(store.get('locationId')) if isinstance(store, dict) else None
+            if loc_id in wanted:
+                stores.append(store)
+                wanted.discard(loc_id)
+                if not wanted:
+                    break
+        return stores
+    return parse
+
+
+def payload_refs(value):
+    if isinstance(value, dict):
+        values = value.values()
+    elif isinstance(value, list):
+        values = value
+    else:
+        return []
+    return [v for v in values if isinstance(v, int) and not isinstance(v, bool) and v >= 0]
+
+
+def parse_nuxt_payload_stream(response):
+    # Reads a Nuxt _payload.json (a flat devalue array) only until the
+    # openingHours subtree of the first element that has one is complete.
+    # Everything before that point is kept since later elements may point back.
+    payload = []
+    seen = set()
+    pending = set()
+    found = False
+
+    def want(refs):
+        stack = list(refs)
+        while stack:
+            ref = stack.pop()
+            if ref in seen:
+                continue
+            seen.add(ref)
+            if ref < len(payload):
+                stack.extend(payload_refs(payload[ref]))
+            else:
+                pending.add(ref)
+
+    for item in iter_json_array(response):
+        index = len(payload)
+        payload.append(item)
+        if index in pending:
+            pending.discard(index)
+            want(payload_refs(item))
+        if not found and isinstance(item, dict) and 'openingHours' in item:
+            found = True
+            opening_hours = item['openingHours']
+            want(payload_refs(opening_hours) if isinstance(opening_hours, dict) else payload_refs([opening_hours]))
+        if found and not pending:
+            break
+    return payload
+
+
+def indexed_source(key, payload, build):
+    # Memoizes build(payload) until the cached payload for key is replaced
+    with source_cache_lock:
+        cached = source_indexes.get(key)
+        if cached is not None and cached[0] is payload:
+            return cached[1]
+    index = build(payload)
+    with source_cache_lock:
+        source_indexes[key] = (payload, index)
+    return index
+
+
+def source_cache_info():
+    with source_cache_lock:
+        stats = dict(source_stats)
+        stats['not_modified_rate'] = round(stats['not_modified'] / stats['requests'], 3) if stats['requests'] else 0
+        return {'size': len(source_cache), 'endpoints': sorted(source_cache), 'transfer': stats}
+
+
+# Users and their stores, {"default_user": ..., "users": {user: {chain: [store, ...]}}}
+STORES_CONFIG_PATH = os.environ.get('STORES_CONFIG_PATH', str(BASE_DIR / 'stores.json'))
+
+
+def load_store_registry(path):
+    with open(path, encoding='utf-8') as f:
+        registry = json.load(f)
+    users = registry['users']
+    default_user = registry.get('default_user') or next(iter(users))
+    if default_user not in users:
+        raise ValueError(f"default_user {default_user!r} has no stores in {path}")
+    return users, default_user
+
+
+USER_STORES, DEFAULT_USER = load_store_registry(STORES_CONFIG_PATH)
+
 
 def get_next_sunday():
     today = datetime.now()
@@ -104,19 +759,536 @@ def get_next_sunday():
         days_ahead += 7
     return today + timedelta(days_ahead)
 
-def is_cache_valid():
-    if cache['data'] is None or cache['timestamp'] is None:
+
+CROATIAN_DAYS = ['Ponedjeljak', 'Utorak', 'Srijeda', 'Četvrtak', 'Petak', 'Subota', 'Nedjelja']
+# Fixed-date public holidays, (month, day) -> name. Easter-based ones are added
+# per year in croatian_holidays().
+CROATIAN_HOLIDAYS = {
+    (1, 1): 'Nova godina',
+    (1, 6): 'Bogojavljenje',
+    (5, 1): 'Praznik rada',
+    (5, 30): 'Dan državnosti',
+    (6, 22): 'Dan antifašističke borbe',
+    (8, 5): 'Dan pobjede i domovinske zahvalnosti',
+    (8, 15): 'Velika Gospa',
+    (11, 1): 'Svi sveti',
+    (11, 18): 'Dan sjećanja na žrtve Domovinskog rata',
+    (12, 25): 'Božić',
+    (12, 26): 'Sveti Stjepan'
+}
+UPCOMING_MAX_WEEKS = int(os.environ.get('UPCOMING_MAX_WEEKS', '8'))
+
+
+def easter_sunday(year):
+    # Anonymous Gregorian algorithm
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return datetime(year, month, day + 1).date()
+
+
+def croatian_holidays(year):
+    holidays = {datetime(year, month, day).date(): name for (month, day), name in CROATIAN_HOLIDAYS.items()}
+    easter = easter_sunday(year)
+    holidays[easter] = 'Uskrs'
+    holidays[easter + timedelta(1)] = 'Uskrsni ponedjeljak'
+    holidays[easter + timedelta(60)] = 'Tijelovo'
+    return holidays
+
+
+def holiday_name(target_date):
+    return croatian_holidays(target_date.year).get(target_date)
+
+
+def is_target_date(target_date):
+    # Only Sundays and public holidays are answered
+    return target_date.weekday() == 6 or holiday_name(target_date) is not None
+
+
+def weekly_hours_apply(target_date):
+    # A chain's regular Sunday hours only say something about an ordinary
+    # Sunday; for a holiday only hours published for that exact date count
+    return target_date.weekday() == 6 and holiday_name(target_date) is None
+
+
+def upcoming_dates(weeks):
+    # The next `weeks` Sundays plus every public holiday up to the last of them
+    first = get_next_sunday().date()
+    last = first + timedelta(weeks=weeks - 1)
+    dates = {first + timedelta(weeks=n) for n in range(weeks)}
+    day = datetime.now().date() + timedelta(1)
+    while day <= last:
+        if holiday_name(day):
+            dates.add(day)
+        day += timedelta(1)
+    return sorted(dates)
+
+
+def resolve_user(user):
+    # Unknown users get the default user's stores (historically Nina's)
+    return user if user in USER_STORES else DEFAULT_USER
+
+
+def resolve_users(value):
+    # 'a,b' -> distinct resolved users in the order given
+    users = [resolve_user(user.strip()) for user in value.split(',') if user.strip()]
+    return list(dict.fromkeys(users)) or [resolve_user('')]
+
+
+def cache_key(user, target_date=None):
+    return (user, target_date or get_next_sunday().date())
+
+
+def is_cache_valid(entry):
+    if entry is None or entry['data'] is None or entry['timestamp'] is None:
         return False
-    now = datetime.now()
-    next_sunday = get_next_sunday().date()
-    if cache['date'] != next_sunday:
+    if entry['date'] <= datetime.now().date():
         return False
-    time_diff = now - cache['timestamp']
-    if time_diff.total_seconds() > CACHE_DURATION_HOURS * 3600:
+    return datetime.now() < entry['expires']
+
+
+def is_cache_stale_servable(entry):
+    if entry is None or entry['data'] is None or entry['date'] <= datetime.now().date():
         return False
-    return True
+    return datetime.now() < entry['expires'] + timedelta(hours=CACHE_STALE_HOURS)
+
+
+def cache_sync_from_disk(keys):
+    # Another worker (or this one before a restart) may have a newer result;
+    # called without cache_lock so the disk read doesn't block other requests
+    if not CACHE_DB_PATH:
+        return
+    with cache_lock:
+        keys = [key for key in keys if not is_cache_valid(cache.get(key))]
+    for key in keys:
+        disk_entry = disk_cache_load(key)
+        if disk_entry is None:
+            continue
+        with cache_lock:
+            entry = cache.get(key)
+            if entry is None or disk_entry['timestamp'] > entry['timestamp']:
+                cache_insert(key, disk_entry)
+
+
+def cache_lookup(key):
+    # Returns (entry, state) where state is 'fresh', 'stale' or 'miss'
+    entry = cache.get(key)
+    if is_cache_valid(entry):
+        cache.move_to_end(key)
+        cache_stats['hits'] += 1
+        return entry, 'fresh'
+    if is_cache_stale_servable(entry):
+        cache.move_to_end(key)
+        cache_stats['stale'] += 1
+        return entry, 'stale'
+    cache_stats['misses'] += 1
+    return None, 'miss'
+
+
+def cache_insert(key, entry):
+    cache[key] = entry
+    cache.move_to_end(key)
+    while len(cache) > CACHE_MAX_ENTRIES:
+        cache.popitem(last=False)
+        cache_stats['evictions'] += 1
+    return entry
+
+
+def cache_put(key, data, ttl_seconds=None):
+    now = datetime.now()
+    if ttl_seconds is None:
+        ttl_seconds = CACHE_DURATION_HOURS * 3600
+    target_date = key[1]
+    # Never outlive the start of the day itself (for the next Sunday that is
+    # when get_next_sunday() rolls over to the following week)
+    rollover = datetime.combine(target_date, dt_time.min)
+    entry = {
+        'data': data,
+        'timestamp': now,
+        'date': target_date,
+        'expires': min(now + timedelta(seconds=ttl_seconds), rollover)
+    }
+    return cache_insert(key, entry)
+
+
+def cache_db():
+    # One connection per thread (and process), reused; the schema is set up
+    # once per process on the first connection
+    global cache_db_ready
+    conn = getattr(cache_db_local, 'conn', None)
+    if conn is not None and cache_db_local.pid == os.getpid():
+        return conn
+    conn = sqlite3.connect(CACHE_DB_PATH, timeout=10)
+    conn.execute('PRAGMA synchronous=NORMAL')
+    with cache_db_lock:
+        if cache_db_ready != os.getpid():
+            conn.execute('PRAGMA journal_mode=WAL')
+            with conn:
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS results ('
+                    'user TEXT, date TEXT, timestamp REAL, expires REAL, data TEXT, PRIMARY KEY (user, date))'
+                )
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS refresh_leases ('
+                    'user TEXT, date TEXT, owner TEXT, expires REAL, PRIMARY KEY (user, date))'
+                )
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS source_validators ('
+                    'key TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, hash TEXT, size INTEGER, data TEXT)'
+                )
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS last_good_rows ('
+                    'store TEXT, date TEXT, timestamp REAL, row TEXT, PRIMARY KEY (store, date))'
+                )
+            cache_db_ready = os.getpid()
+    cache_db_local.conn = conn
+    cache_db_local.pid = os.getpid()
+    return conn
+
+
+def disk_cache_load(key):
+    if not CACHE_DB_PATH:
+        return None
+    user, target_date = key
+    try:
+        conn = cache_db()
+        row = conn.execute(
+            'SELECT timestamp, expires, data FROM results WHERE user = ? AND date = ?',
+            (user, target_date.isoformat())
+        ).fetchone()
+    except Exception as e:
+        log_event(logging.WARNING, "Cache DB read error", error=e)
+        return None
+    if row is None:
+        return None
+    return {
+        'data': json.loads(row[2]),
+        'timestamp': datetime.fromtimestamp(row[0]),
+        'date': target_date,
+        'expires': datetime.fromtimestamp(row[1])
+    }
+
+
+def disk_cache_store(key, entry):
+    if not CACHE_DB_PATH:
+        return
+    user, target_date = key
+    try:
+        conn = cache_db()
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO results (user, date, timestamp, expires, data) VALUES (?, ?, ?, ?, ?)',
+                (user, target_date.isoformat(), entry['timestamp'].timestamp(),
+                 entry['expires'].timestamp(), json.dumps(entry['data']))
+            )
+            # Past Sundays are never asked for again
+            conn.execute('DELETE FROM results WHERE date < ?', (datetime.now().date().isoformat(),))
+    except Exception as e:
+        log_event(logging.WARNING, "Cache DB write error", error=e)
+
+
+def source_validators_load(key):
+    # Validators and the parsed document they belong to, so a 304 after a
+    # restart still has something to reuse
+    if not CACHE_DB_PATH:
+        return None
+    try:
+        conn = cache_db()
+        row = conn.execute(
+            'SELECT etag, last_modified, hash, size, data FROM source_validators WHERE key = ?', (key,)
+        ).fetchone()
+    except Exception as e:
+        log_event(logging.WARNING, "Cache DB read error", error=e)
+        return None
+    if row is None:
+        return None
+    return {
+        'data': json.loads(row[4]),
+        'timestamp': datetime.fromtimestamp(0),
+        'etag': row[0],
+        'last_modified': row[1],
+        'hash': row[2],
+        'size': row[3]
+    }
+
+
+def source_validators_store(key, entry):
+    if not CACHE_DB_PATH:
+        return
+    try:
+        conn = cache_db()
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO source_validators (key, etag, last_modified, hash, size, data) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (key, entry['etag'], entry['last_modified'], entry['hash'], entry['size'], json.dumps(entry['data']))
+            )
+    except Exception as e:
+        log_event(logging.WARNING, "Cache DB write error", error=e)
+
+
+def last_good_load(target_date, stores):
+    # store -> (row, timestamp) as saved by any worker
+    if not CACHE_DB_PATH or not stores:
+        return {}
+    try:
+        conn = cache_db()
+        rows = conn.execute(
+            'SELECT store, timestamp, row FROM last_good_rows WHERE date = ? AND store IN ({})'.format(
+                ','.join('?' * len(stores))
+            ),
+            [target_date.isoformat()] + list(stores)
+        ).fetchall()
+    except Exception as e:
+        log_event(logging.WARNING, "Cache DB read error", error=e)
+        return {}
+    return {store: (json.loads(row), datetime.fromtimestamp(timestamp)) for store, timestamp, row in rows}
+
+
+def last_good_store(target_date, rows, timestamp):
+    if not CACHE_DB_PATH or not rows:
+        return
+    try:
+        conn = cache_db()
+        with conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO last_good_rows (store, date, timestamp, row) VALUES (?, ?, ?, ?)',
+                [(row['name'], target_date.isoformat(), timestamp.timestamp(), json.dumps(row)) for row in rows]
+            )
+            conn.execute('DELETE FROM last_good_rows WHERE date < ?', (datetime.now().date().isoformat(),))
+    except Exception as e:
+        log_event(logging.WARNING, "Cache DB write error", error=e)
+
+
+def acquire_refresh_lease(key):
+    # Cross-process lock: only one worker refreshes a key at a time
+    if not CACHE_DB_PATH:
+        return True
+    user, target_date = key
+    owner = str(os.getpid())
+    now = time.time()
+    conn = None
+    try:
+        conn = cache_db()
+        conn.execute('BEGIN IMMEDIATE')
+        row = conn.execute(
+            'SELECT owner, expires FROM refresh_leases WHERE user = ? AND date = ?',
+            (user, target_date.isoformat())
+        ).fetchone()
+        if row is not None and row[0] != owner and row[1] > now:
+            conn.rollback()
+            return False
+        conn.execute(
+            'INSERT OR REPLACE INTO refresh_leases (user, date, owner, expires) VALUES (?, ?, ?, ?)',
+            (user, target_date.isoformat(), owner, now + REFRESH_LEASE_SECONDS)
+        )
+        conn.commit()
+        return True
+    except Exception as e:
+        # The connection is reused, so don't leave it inside the transaction
+        if conn is not None and conn.in_transaction:
+            conn.rollback()
+        log_event(logging.WARNING, "Cache DB lease error", error=e)
+        return True
+
+
+def release_refresh_lease(key):
+    if not CACHE_DB_PATH:
+        return
+    user, target_date = key
+    try:
+        conn = cache_db()
+        with conn:
+            conn.execute(
+                'DELETE FROM refresh_leases WHERE user = ? AND date = ? AND owner = ?',
+                (user, target_date.isoformat(), str(os.getpid()))
+            )
+    except Exception as e:
+        log_event(logging.WARNING, "Cache DB lease error", error=e)
+
+
+def refresh_batch(todo, stagger=0):
+    # Refreshes [(key, user)] sharing one date in a single fetch pass and
+    # resolves the keys' futures in inflight_refreshes
+    started = datetime.now()
+    target_date = todo[0][0][1]
+    results = {}
+    error = None
+    try:
+        pending = list(todo)
+        while pending:
+            for key, user in list(pending):
+                # Another worker refreshed this key since we started; use its
+                # result rather than taking the lease it just released
+                entry = disk_cache_load(key)
+                if entry is not None and entry['timestamp'] >= started:
+                    with cache_lock:
+                        cache_insert(key, entry)
+                    results[key] = entry['data']
+                    pending.remove((key, user))
+            leased = [(key, user) for key, user in pending if acquire_refresh_lease(key)]
+            if leased:
+                try:
+                    keys = {user: key for key, user in leased}
+                    batch = fetch_fresh_batch(
+                        [user for _, user in leased], stagger,
+                        lambda user, rows: publish_rows(keys[user], rows), target_date
+                    )
+                    for key, user in leased:
+                        with cache_lock:
+                            entry = cache_put(key, batch[user], result_ttl(batch[user]))
+                        disk_cache_store(key, entry)
+                        results[key] = batch[user]
+                finally:
+                    for key, _ in leased:
+                        release_refresh_lease(key)
+
+            pending = [(key, user) for key, user in pending if key not in results]
+            if pending:
+                time.sleep(0.5)
+    except Exception as e:
+        error = e
+    finally:
+        for key, _ in todo:
+            with cache_lock:
+                future = inflight_refreshes.pop(key, None)
+                progress = refresh_progress.pop(key, None)
+            if progress:
+                for listener in progress['listeners']:
+                    listener.put(None)
+            if future is None:
+                continue
+            if key in results:
+                future.set_result(results[key])
+            else:
+                future.set_exception(error or Exception('Refresh did not finish'))
+
+
+def publish_rows(key, rows):
+    with cache_lock:
+        progress = refresh_progress.get(key)
+        if progress is None:
+            return
+        progress['rows'].extend(rows)
+        for listener in progress['listeners']:
+            listener.put(rows)
+
+
+def subscribe_rows(key):
+    # Returns (rows so far, queue of later row batches ending with None) for an
+    # in-flight refresh. Must be called with cache_lock held.
+    progress = refresh_progress.get(key)
+    listener = Queue()
+    if progress is None:
+        listener.put(None)
+        return [], listener
+    progress['listeners'].append(listener)
+    return list(progress['rows']), listener
+
+
+def start_refresh(key, user, stagger=0):
+    # Must be called with cache_lock held.
+    return start_batch_refresh([(key, user)], stagger)[key]
+
+
+def start_batch_refresh(pairs, stagger=0):
+    # Single flight: callers for the same key share one in-flight refresh, and
+    # keys not yet in flight are refreshed together, one batch per date.
+    # Returns {key: future}. Must be called with cache_lock held.
+    futures = {}
+    batches = {}
+    for key, user in pairs:
+        future = inflight_refreshes.get(key)
+        if future is not None:
+            cache_stats['coalesced'] += 1
+        else:
+            future = Future()
+            inflight_refreshes[key] = future
+            refresh_progress[key] = {'rows': [], 'listeners': []}
+            batches.setdefault(key[1], []).append((key, user))
+        futures[key] = future
+    for todo in batches.values():
+        refresh_executor.submit(refresh_batch, todo, stagger)
+    return futures
+
+
+def cache_info():
+    with cache_lock:
+        return dict(cache_stats, size=len(cache), max_size=CACHE_MAX_ENTRIES, inflight=len(inflight_refreshes))
+
 
-def check_spar(stores_config):
+def spar_time(value):
+    return (value['hourOfDay'], value['minute'])
+
+
+def build_spar_index(all_stores):
+    # locationId -> {'sunday': (from, to) or None, 'special': {date: override}}.
+    # Only the first store per id and the first special entry per date count.
+    index = {}
+    for store in all_stores:
+        loc_id = str(store.get('locationId'))
+        if loc_id in index:
+            continue
+        try:
+            index[loc_id] = build_spar_record(store)
+        except Exception as e:
+            # Surfaced only if one of our stores is the broken one
+            index[loc_id] = {'error': str(e)}
+    return index
+
+
+def build_spar_record(store):
+    sunday = None
+    for item in store.get('shopHours', []):
+        oh = item.get('openingHours', {})
+        if oh.get('dayType') == 'nedjelja':
+            from1 = oh.get('from1')
+            to1 = oh.get('to1')
+            if from1 and to1:
+                sunday = (spar_time(from1), spar_time(to1))
+            break
+
+    special = {}
+    for item in store.get('specialShopHours', []):
+        oh = item.get('openingHours', {})
+        day = oh.get('dayType')
+        if not day:
+            continue
+
+        try:
+            special_date = datetime(
+                day['year'],
+                day['month'] + 1,
+                day['dayOfMonth']
+            ).date()
+        except Exception as e:
+            log_event(logging.WARNING, "Special date parse error", chain='spar', store=store.get('locationId'), error=e)
+            continue
+
+        if special_date in special:
+            continue
+        from1 = oh.get('from1')
+        to1 = oh.get('to1')
+        try:
+            special[special_date] = {
+                'closed': from1 is None and to1 is None,
+                'hours': (spar_time(from1), spar_time(to1)) if from1 and to1 else None
+            }
+        except Exception as e:
+            special[special_date] = {'error': str(e)}
+
+    return {'sunday': sunday, 'special': special}
+
+
+def check_spar(stores_config, target_date=None):
+    target_date = target_date or get_next_sunday().date()
     results = []
     spar_stores = stores_config.get('spar', [])
     
@@ -129,99 +1301,77 @@ def check_spar(stores_config):
         })
 
     try:
-        print("Checking Spar...")
+        log_event(logging.DEBUG, "Checking", chain='spar', stores=len(spar_stores))
         url = "https://www.spar.hr/lokacije/_jcr_content.stores.v2.html"
-        response = requests.get(url, timeout=15)
-        response.raise_for_status()
-        all_stores = response.json()
-        print(f"Spar API returned {len(all_stores)} stores")
+        if STREAM_PARSE:
+            # Every user's Spar ids, so the trimmed list can be shared across users
+            targets = {str(store['id']) for config in USER_STORES.values() for store in config.get('spar', [])}
+            targets.update(str(store['id']) for store in spar_stores)
+            all_stores = fetch_source(
+                url,
+                parse=parse_spar_stream(targets),
+                variant='locationId=' + ','.join(sorted(targets)),
+                timeout=15,
+                stream=True
+            )
+        else:
+            all_stores = fetch_source(url, timeout=15)
+        index = indexed_source(url, all_stores, build_spar_index)
+        log_event(logging.DEBUG, "Store list fetched", chain='spar', stores=len(all_stores))
 
-        next_sunday = get_next_sunday().date()
         results = []
 
         for my_store in spar_stores:
-            my_id = str(my_store['id'])
-            found = False
-
-            for store in all_stores:
-                loc_id = str(store.get('locationId'))
-                if loc_id != my_id:
-                    continue
-
-                found = True
-                sunday_from = None
-                sunday_to = None
-
-                for item in store.get('shopHours', []):
-                    oh = item.get('openingHours', {})
-                    if oh.get('dayType') == 'nedjelja':
-                        from1 = oh.get('from1')
-                        to1 = oh.get('to1')
-                        if from1 and to1:
-                            sunday_from = (from1['hourOfDay'], from1['minute'])
-                            sunday_to = (to1['hourOfDay'], to1['minute'])
-                        break
-
-                closed_override = False
-                for special in store.get('specialShopHours', []):
-                    oh = special.get('openingHours', {})
-                    day = oh.get('dayType')
-                    if not day:
-                        continue
-
-                    try:
-                        special_date = datetime(
-                            day['year'],
-                            day['month'] + 1,
-                            day['dayOfMonth']
-                        ).date()
-                    except Exception as e:
-                        print(f"SPAR special date parse error: {e}")
-                        continue
-
-                    if special_date != next_sunday:
-                        continue
-
-                    from1 = oh.get('from1')
-                    to1 = oh.get('to1')
-                    if from1 is None and to1 is None:
-                        closed_override = True
-                        sunday_from = None
-                        sunday_to = None
-                    elif from1 and to1:
-                        sunday_from = (from1['hourOfDay'], from1['minute'])
-                        sunday_to = (to1['hourOfDay'], to1['minute'])
-                    break
+            record = index.get(str(my_store['id']))
+            if record is None:
+                results.append({
+                    'chain': 'SPAR',
+                    'name': my_store['name'],
+                    'open': False,
+                    'hours': 'Trgovina ne postoji u API-ju'
+                })
+                continue
 
-                if sunday_from and sunday_to:
-                    from_h, from_m = sunday_from
-                    to_h, to_m = sunday_to
-                    results.append({
-                        'chain': 'SPAR',
-                        'name': my_store['name'],
-                        'open': True,
-                        'hours': f"{from_h:02d}:{from_m:02d} - {to_h:02d}:{to_m:02d}"
-                    })
+            if 'error' in record:
+                raise Exception(record['error'])
+
+            unknown = not weekly_hours_apply(target_date)
+            hours = None if unknown else record['sunday']
+            closed_override = False
+            special = record['special'].get(target_date)
+            if special is not None:
+                if 'error' in special:
+                    raise Exception(special['error'])
+                if special['closed']:
+                    closed_override = True
+                    unknown = False
+                    hours = None
+                elif special['hours']:
+                    unknown = False
+                    hours = special['hours']
+
+            if hours:
+                (from_h, from_m), (to_h, to_m) = hours
+                results.append({
+                    'chain': 'SPAR',
+                    'name': my_store['name'],
+                    'open': True,
+                    'hours': f"{from_h:02d}:{from_m:02d} - {to_h:02d}:{to_m:02d}"
+                })
+            else:
+                if unknown:
+                    status = 'Nema podataka'
                 else:
-                    status = 'Zatvoreno' if closed_override or sunday_from is None else 'Nema podataka'
-                    results.append({
-                        'chain': 'SPAR',
-                        'name': my_store['name'],
-                        'open': False,
-                        'hours': status
-                    })
-                break
-
-            if not found:
+                    status = 'Zatvoreno' if closed_override or hours is None else 'Nema podataka'
                 results.append({
                     'chain': 'SPAR',
                     'name': my_store['name'],
                     'open': False,
-                    'hours': 'Trgovina ne postoji u API-ju'
+                    'hours': status
                 })
 
     except Exception as e:
-        print(f"Spar error: {e}")
+        log_event(logging.WARNING, "Check failed", chain='spar', error=e)
         results = []
         for my_store in spar_stores:
             results.append({
@@ -234,7 +1384,37 @@ def check_spar(stores_config):
     return results
 
 
-def check_konzum(stores_config):
+def build_konzum_index(data):
+    # id -> {'open_this_sunday', 'sunday': (from, to) or None, 'error'} with
+    # the work_hours JSON string decoded once per payload
+    if isinstance(data, dict):
+        all_stores = data.get('locations', []) or data.get('data', []) or []
+    elif isinstance(data, list):
+        all_stores = data
+    else:
+        all_stores = []
+
+    index = {}
+    for store in all_stores:
+        store_id = store.get('id')
+        if store_id in index:
+            continue
+        record = {'open_this_sunday': bool(store.get('open_this_sunday')), 'sunday': None, 'error': None}
+        if record['open_this_sunday']:
+            try:
+                work_hours = json.loads(store.get('work_hours', '[]'))
+                for day in work_hours:
+                    if day.get('name') == 'Nedjelja' and day.get('from_hour'):
+                        record['sunday'] = (day['from_hour'].split('T')[1][:5], day['to_hour'].split('T')[1][:5])
+                        break
+            except Exception as e:
+                log_event(logging.WARNING, "Work hours parse error", chain='konzum', store=store_id, error=e)
+                record['error'] = str(e)
+        index[store_id] = record
+    return index
+
+
+def check_konzum(stores_config, target_date=None):
     results = []
     konzum_stores = stores_config.get('konzum', [])
     
@@ -242,61 +1422,49 @@ def check_konzum(stores_config):
         results.append({'chain': 'KONZUM', 'name': my_store['name'], 'open': False, 'hours': 'Provjeravam...'})
     
     try:
-        print("Checking Konzum...")
+        log_event(logging.DEBUG, "Checking", chain='konzum', stores=len(konzum_stores))
         url = "https://trgovine.konzum.hr/api/locations/"
-        response = requests.get(url, timeout=15)
-        response.raise_for_status()
-        data = response.json()
-        
-        if isinstance(data, dict):
-            all_stores = data.get('locations', []) or data.get('data', []) or []
-        elif isinstance(data, list):
-            all_stores = data
-        else:
-            all_stores = []
+        data = fetch_source(url, timeout=15)
+        index = indexed_source(url, data, build_konzum_index)
         
+        # open_this_sunday only speaks for the coming Sunday
+        known = target_date is None or target_date == get_next_sunday().date()
+
         results = []
         for my_store in konzum_stores:
-            found = False
-            for store in all_stores:
-                if store.get('id') == my_store['id']:
-                    found = True
-                    if store.get('open_this_sunday'):
-                        work_hours_str = store.get('work_hours', '[]')
-                        try:
-                            work_hours = json.loads(work_hours_str)
-                            for day in work_hours:
-                                if day.get('name') == 'Nedjelja' and day.get('from_hour'):
-                                    from_time = day['from_hour'].split('T')[1][:5]
-                                    to_time = day['to_hour'].split('T')[1][:5]
-                                    results.append({'chain': 'KONZUM', 'name': my_store['name'], 'open': True, 'hours': f"{from_time} - {to_time}"})
-                                    break
-                        except Exception as e:
-                            print(f"Konzum parse error: {e}")
-                            results.append({'chain': 'KONZUM', 'name': my_store['name'], 'open': False, 'hours': 'Greska'})
-                    else:
-                        results.append({'chain': 'KONZUM', 'name': my_store['name'], 'open': False, 'hours': 'Zatvoreno'})
-                    break
-            if not found:
+            record = index.get(my_store['id'])
+            if record is None:
                 results.append({'chain': 'KONZUM', 'name': my_store['name'], 'open': False, 'hours': 'Trgovina ne postoji'})
+            elif not known:
+                results.append({'chain': 'KONZUM', 'name': my_store['name'], 'open': False, 'hours': 'Nema podataka'})
+            elif not record['open_this_sunday']:
+                results.append({'chain': 'KONZUM', 'name': my_store['name'], 'open': False, 'hours': 'Zatvoreno'})
+            elif record['error']:
+                results.append({'chain': 'KONZUM', 'name': my_store['name'], 'open': False, 'hours': 'Greska'})
+            elif record['sunday']:
+                from_time, to_time = record['sunday']
+                results.append({'chain': 'KONZUM', 'name': my_store['name'], 'open': True, 'hours': f"{from_time} - {to_time}"})
     except Exception as e:
-        print(f"Konzum error: {e}")
+        log_event(logging.WARNING, "Check failed", chain='konzum', error=e)
         results = []
         for my_store in konzum_stores:
             results.append({'chain': 'KONZUM', 'name': my_store['name'], 'open': False, 'hours': f'Greska: {str(e)[:30]}'})
     return results
 
-def check_kaufland(stores_config):
+def check_kaufland(stores_config, target_date=None):
     results = []
     kaufland_stores = stores_config.get('kaufland', [])
     
+    # The store API only has the weekly hours
+    if not weekly_hours_apply(target_date or get_next_sunday().date()):
+        return [{'chain': 'KAUFLAND', 'name': store['name'], 'open': False, 'hours': 'Nema podataka'}
+                for store in kaufland_stores]
+
     for my_store in kaufland_stores:
         try:
-            print(f"Checking Kaufland {my_store['id']}...")
+            log_event(logging.DEBUG, "Checking", chain='kaufland', store=my_store['id'])
             url = f"https://www.kaufland.hr/.klstorebygeo.storeName={my_store['id']}.json"
-            response = requests.get(url, timeout=15)
-            response.raise_for_status()
-            store = response.json()
+            store = fetch_source(url, timeout=15)
             for day in store.get('wod', []):
                 if day.startswith('Sunday'):
                     parts = day.split('|')
@@ -309,37 +1477,237 @@ def check_kaufland(stores_config):
                             results.append({'chain': 'KAUFLAND', 'name': my_store['name'], 'open': True, 'hours': f"{from_time} - {to_time}"})
                     break
         except Exception as e:
-            print(f"Kaufland error: {e}")
+            log_event(logging.WARNING, "Check failed", chain='kaufland', store=my_store['id'], error=e)
             results.append({'chain': 'KAUFLAND', 'name': my_store['name'], 'open': False, 'hours': f'Greska: {str(e)[:30]}'})
     return results
 
 
-def check_studenac(stores_config):
+STUDENAC_HOURS_CLASS = 'marketsingleworkhours'
+# Tags html.parser (and BeautifulSoup on top of it) treat as having no content
+VOID_TAGS = {
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link',
+    'menuitem', 'meta', 'param', 'source', 'track', 'wbr'
+}
+# Text inside these never shows up in get_text() of an ordinary tag
+HIDDEN_TEXT_TAGS = {'script', 'style', 'template'}
+
+
+HTML_TOKEN_RE = re.compile(r"""
+    <!--.*?(?:--!?>|\Z)
+  | <!\[CDATA\[(?P<cdata>.*?)\]\]>
+  | <[!?][^>]*>?
+  | </(?P<end>[a-zA-Z][^\t\n\r\f />]*)[^>]*>
+  | <(?P<start>[a-zA-Z][^\t\n\r\f />]*)(?P<attrs>(?:[^>"']|"[^"]*"|'[^']*')*)>
+""", re.S | re.X)
+HTML_CLASS_RE = re.compile(r"""\bclass\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))""", re.I)
+
+
+def html_classes(attrs):
+    match = HTML_CLASS_RE.search(attrs)
+    if not match:
+        return []
+    return (match.group(1) or match.group(2) or match.group(3) or '').split()
+
+
+class TreeTextParser:
+    # Single regex pass over the markup that nests elements the way
+    # BeautifulSoup's html.parser builder does and reports the stripped
+    # strings get_text(' ', strip=True) would join, without building a tree.
+    # Subclasses hook open_element (its return value is kept on the stack),
+    # close_element and handle_string.
+
+    def __init__(self):
+        self.stack = []  # (tag, element) for open elements, innermost last
+        self.open_counts = {}
+        self.hidden = 0
+        self.stopped = False
+
+    def open_element(self, tag, attrs):
+        return None
+
+    def close_element(self, tag, element):
+        pass
+
+    def handle_string(self, text):
+        pass
+
+    def stop(self):
+        self.stopped = True
+
+    def handle_text(self, text):
+        if self.hidden:
+            return
+        text = html_unescape(text).strip()
+        if text:
+            self.handle_string(text)
+
+    def start_tag(self, tag, attrs):
+        element = self.open_element(tag, attrs)
+        if tag in VOID_TAGS:
+            self.close_element(tag, element)
+            return
+        self.stack.append((tag, element))
+        self.open_counts[tag] = self.open_counts.get(tag, 0) + 1
+        if tag in HIDDEN_TEXT_TAGS:
+            self.hidden += 1
+
+    def end_tag(self, tag):
+        # Unmatched end tags are ignored, otherwise everything opened since is closed too
+        if not self.open_counts.get(tag):
+            return
+        while self.stack:
+            open_tag, element = self.stack.pop()
+            self.open_counts[open_tag] -= 1
+            if open_tag in HIDDEN_TEXT_TAGS:
+                self.hidden -= 1
+            self.close_element(open_tag, element)
+            if open_tag == tag:
+                break
+
+    def feed(self, html, pos=0):
+        search = HTML_TOKEN_RE.search
+        handle_text = self.handle_text
+        length = len(html)
+        while pos < length and not self.stopped:
+            match = search(html, pos)
+            if match is None:
+                handle_text(html[pos:])
+                break
+            token_start = match.start()
+            if token_start > pos:
+                handle_text(html[pos:token_start])
+            pos = match.end()
+            cdata, end, start, attrs = match.groups()
+            if start:
+                tag = start.lower()
+                self.start_tag(tag, attrs)
+                if attrs.endswith('/'):
+                    self.end_tag(tag)
+                elif tag in ('script', 'style'):
+                    # Raw text up to the matching end tag
+                    close = re.compile(r'</%s[\t\n\r\f />]' % tag, re.I).search(html, pos)
+                    raw_end = close.start() if close else length
+                    handle_text(html[pos:raw_end])
+                    pos = raw_end
+            elif end:
+                self.end_tag(end.lower())
+            elif cdata is not None:
+                text = cdata.strip()
+                if text:
+                    self.handle_string(text)
+
+    def close(self):
+        while self.stack:
+            open_tag, element = self.stack.pop()
+            self.close_element(open_tag, element)
+
+
+class StudenacHoursParser(TreeTextParser):
+    # Fed from the work-hours <div> onwards; collects the text of each <li>
+    # inside it and stops once that <div> is closed
+
+    def __init__(self):
+        super().__init__()
+        self.li_texts = []
+        self.in_target = False
+        self.done = False
+
+    def open_element(self, tag, attrs):
+        if self.done:
+            return None
+        if not self.in_target:
+            if tag == 'div' and STUDENAC_HOURS_CLASS in html_classes(attrs):
+                self.in_target = True
+                return 'target'
+            # Not the block we jumped to, leave it to the BeautifulSoup fallback
+            self.stop()
+            return None
+        if tag == 'li':
+            self.li_texts.append([])
+            return len(self.li_texts) - 1
+        return None
+
+    def close_element(self, tag, element):
+        if element == 'target':
+            self.done = True
+            self.stop()
+
+    def handle_string(self, text):
+        if self.done or not self.in_target:
+            return
+        for _, element in self.stack:
+            if isinstance(element, int):
+                self.li_texts[element].append(text)
+
+
+def find_studenac_sunday_fast(html):
+    # Jump straight to the work-hours <div> and tokenize only that fragment
+    pos = html.find(STUDENAC_HOURS_CLASS)
+    while pos != -1:
+        start = html.rfind('<', 0, pos)
+        if start != -1 and html[start:start + 4].lower() == '<div' and '>' not in html[start:pos]:
+            break
+        pos = html.find(STUDENAC_HOURS_CLASS, pos + 1)
+    if pos == -1:
+        return None
+
+    parser = StudenacHoursParser()
+    parser.feed(html, start)
+    parser.close()
+    if not parser.in_target:
+        return None
+    for pieces in parser.li_texts:
+        txt = ' '.join(pieces)
+        if 'Nedjelja' in txt:
+            return txt
+    return None
+
+
+def find_studenac_sunday_soup(html):
+    soup = BeautifulSoup(html, 'html.parser')
+    work_hours_div = soup.find('div', class_=STUDENAC_HOURS_CLASS)
+    if not work_hours_div:
+        lis = soup.find_all('li')
+    else:
+        lis = work_hours_div.find_all('li')
+
+    for li in lis:
+        txt = li.get_text(separator=' ', strip=True)
+        if 'Nedjelja' in txt:
+            return txt
+    return None
+
+
+def find_studenac_sunday(html):
+    try:
+        sunday_text = find_studenac_sunday_fast(html)
+    except Exception as e:
+        log_event(logging.WARNING, "Fast parse error, using the full parser", chain='studenac', error=e)
+        sunday_text = None
+    if sunday_text is None:
+        # Page layout changed or no work-hours block: fall back to the full tree
+        sunday_text = find_studenac_sunday_soup(html)
+    return sunday_text
+
+
+def check_studenac(stores_config, target_date=None):
     results = []
     studenac_stores = stores_config.get('studenac', [])
 
+    # The store page only lists the weekly hours
+    if not weekly_hours_apply(target_date or get_next_sunday().date()):
+        return [{'chain': 'STUDENAC', 'name': store['name'], 'open': False, 'hours': 'Nema podataka'}
+                for store in studenac_stores]
+
     for my_store in studenac_stores:
         name = my_store['name']
         url = my_store['url']
 
         try:
-            print(f"Scraping Studenac HTML: {url}")
-            resp = requests.get(url, timeout=15, headers=HEADERS)
-            resp.raise_for_status()
-
-            soup = BeautifulSoup(resp.text, 'html.parser')
-            work_hours_div = soup.find('div', class_='marketsingleworkhours')
-            if not work_hours_div:
-                lis = soup.find_all('li')
-            else:
-                lis = work_hours_div.find_all('li')
+            log_event(logging.DEBUG, "Checking", chain='studenac', store=url)
+            html = fetch_source(url, parse=parse_text, timeout=15, headers=HEADERS)
 
-            sunday_text = None
-            for li in lis:
-                txt = li.get_text(separator=' ', strip=True)
-                if 'Nedjelja' in txt:
-                    sunday_text = txt
-                    break
+            sunday_text = find_studenac_sunday(html)
 
             if not sunday_text:
                 results.append({
@@ -377,7 +1745,7 @@ def check_studenac(stores_config):
                     })
 
         except Exception as e:
-            print(f"Studenac scrape error for {url}: {e}")
+            log_event(logging.WARNING, "Check failed", chain='studenac', store=url, error=e)
             results.append({
                 'chain': 'STUDENAC',
                 'name': name,
@@ -387,43 +1755,41 @@ def check_studenac(stores_config):
 
     return results
 
-def check_dm(stores_config):
+def check_dm(stores_config, target_date=None):
     results = []
     dm_stores = stores_config.get('dm', [])
-    next_sunday = get_next_sunday().date()
+    target_date = target_date or get_next_sunday().date()
 
     for my_store in dm_stores:
         store_id = my_store['storeId']
         name = my_store['name']
         
         try:
-            print(f"Checking DM {store_id} via API...")
+            log_event(logging.DEBUG, "Checking", chain='dm', store=store_id)
             url = f"https://store-data-service.services.dmtech.com/stores/item/{store_id}"
-            response = requests.get(url, timeout=15, headers=HEADERS)
-            response.raise_for_status()
-            store_data = response.json()
-            
-            print(f"DM API: Got response for {store_id}")
+            store_data = fetch_source(url, timeout=15, headers=HEADERS)
             
             # Check standard opening hours (weekDay: 0 or 7 = Sunday)
             sunday_hours = None
-            for hours in store_data.get('openingHours', []):
+            known = weekly_hours_apply(target_date)
+            for hours in store_data.get('openingHours', []) if known else []:
                 if hours.get('weekDay') in [0, 7]:
                     time_ranges = hours.get('timeRanges', [])
                     if time_ranges:
                         sunday_hours = time_ranges[0]
-                        print(f"DM: Found Sunday in openingHours: {sunday_hours}")
+                        log_event(logging.DEBUG, "Hours from openingHours", chain='dm', store=store_id, hours=sunday_hours)
                     break
             
-            # Check extraOpeningDays for this specific Sunday
+            # Check extraOpeningDays for this specific date
             for extra_day in store_data.get('extraOpeningDays', []):
                 try:
                     extra_date = datetime.strptime(extra_day['date'], '%Y-%m-%d').date()
-                    if extra_date == next_sunday:
+                    if extra_date == target_date:
+                        known = True
                         time_ranges = extra_day.get('timeRanges', [])
                         if time_ranges:
                             sunday_hours = time_ranges[0]
-                            print(f"DM: Found Sunday in extraOpeningDays: {sunday_hours}")
+                            log_event(logging.DEBUG, "Hours from extraOpeningDays", chain='dm', store=store_id, hours=sunday_hours)
                         break
                 except:
                     continue
@@ -433,14 +1799,22 @@ def check_dm(stores_config):
             for closing_date in store_data.get('extraClosingDates', []):
                 try:
                     close_date = datetime.strptime(closing_date['date'], '%Y-%m-%d').date()
-                    if close_date == next_sunday:
+                    if close_date == target_date:
+                        known = True
                         is_closed = True
-                        print(f"DM: Found Sunday in extraClosingDates - closed")
+                        log_event(logging.DEBUG, "Closed by extraClosingDates", chain='dm', store=store_id)
                         break
                 except:
                     continue
             
-            if is_closed or not sunday_hours:
+            if not known:
+                results.append({
+                    'chain': 'DM',
+                    'name': name,
+                    'open': False,
+                    'hours': 'Nema podataka'
+                })
+            elif is_closed or not sunday_hours:
                 results.append({
                     'chain': 'DM',
                     'name': name,
@@ -456,9 +1830,7 @@ def check_dm(stores_config):
                 })
                 
         except Exception as e:
-            print(f"DM API error for {store_id}: {e}")
-            import traceback
-            traceback.print_exc()
+            log_error("Check failed", e, chain='dm', store=store_id)
             results.append({
                 'chain': 'DM',
                 'name': name,
@@ -471,10 +1843,15 @@ def check_dm(stores_config):
 
 
 
-def check_muller(stores_config):
+def check_muller(stores_config, target_date=None):
     results = []
     muller_stores = stores_config.get('muller', [])
 
+    # The API only has the weekly hours
+    if not weekly_hours_apply(target_date or get_next_sunday().date()):
+        return [{'chain': 'MÜLLER', 'name': store['name'], 'open': False, 'hours': 'Nema podataka'}
+                for store in muller_stores]
+
     # Müller GraphQL API credentials
     muller_headers = {
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
@@ -491,7 +1868,7 @@ def check_muller(stores_config):
         name = my_store['name']
         
         try:
-            print(f"Checking Müller {store_id} via GraphQL API...")
+            log_event(logging.DEBUG, "Checking", chain='muller', store=store_id)
             
             url = "https://backend.prod.ecom.mueller.hr/"
             params = {
@@ -509,11 +1886,7 @@ def check_muller(stores_config):
                 })
             }
             
-            response = requests.get(url, params=params, headers=muller_headers, timeout=15)
-            response.raise_for_status()
-            data = response.json()
-            
-            print(f"Müller API: Got response for {store_id}")
+            data = fetch_source(url, params=params, headers=muller_headers, timeout=15)
             
             store_data = data.get('data', {}).get('getStoreById', {})
             opening_hours = store_data.get('openingHours', [])
@@ -530,7 +1903,7 @@ def check_muller(stores_config):
                 closing = sunday_hours.get('closingTime')
                 
                 if opening and closing:
-                    print(f"Müller: Found Sunday hours: {opening} - {closing}")
+                    log_event(logging.DEBUG, "Sunday hours found", chain='muller', store=store_id, hours=f'{opening} - {closing}')
                     results.append({
                         'chain': 'MÜLLER',
                         'name': name,
@@ -545,7 +1918,7 @@ def check_muller(stores_config):
                         'hours': 'Zatvoreno'
                     })
             else:
-                print(f"Müller: Sunday not found - closed")
+                log_event(logging.DEBUG, "No Sunday hours, closed", chain='muller', store=store_id)
                 results.append({
                     'chain': 'MÜLLER',
                     'name': name,
@@ -554,9 +1927,7 @@ def check_muller(stores_config):
                 })
                 
         except Exception as e:
-            print(f"Müller API error for {store_id}: {e}")
-            import traceback
-            traceback.print_exc()
+            log_error("Check failed", e, chain='muller', store=store_id)
             results.append({
                 'chain': 'MÜLLER',
                 'name': name,
@@ -568,62 +1939,102 @@ def check_muller(stores_config):
 
 
 
-def check_plodine(stores_config):
+PLODINE_HOURS_TAGS = {'div', 'table', 'ul', 'li', 'p', 'span', 'td'}
+PLODINE_SUNDAY_WORDS = ('Nedjelja', 'nedjelja', 'NEDJELJA')
+PLODINE_CLOSED_WORDS = ('Zatvoreno', 'zatvoreno', 'ZATVORENO')
+PLODINE_HOURS_RE = re.compile(r'(\d{1,2}[:.]\d{2})\s*[-–—]\s*(\d{1,2}[:.]\d{2})')
+
+
+class PlodineTextParser(TreeTextParser):
+    # Records every stripped string once, plus the [start, end) range of
+    # strings under each div/table/ul/li/p/span/td in document order
+
+    def __init__(self):
+        super().__init__()
+        self.strings = []
+        self.ranges = []
+
+    def open_element(self, tag, attrs):
+        if tag not in PLODINE_HOURS_TAGS:
+            return None
+        element = [len(self.strings), len(self.strings)]
+        self.ranges.append(element)
+        return element
+
+    def close_element(self, tag, element):
+        if element is not None:
+            element[1] = len(self.strings)
+
+    def handle_string(self, text):
+        self.strings.append(text)
+
+
+def find_plodine_sunday(html):
+    # Returns (open, hours) from the first tag in document order whose text
+    # mentions Sunday and either says closed or contains a time range, or None.
+    # Same answer as calling get_text() on every tag, in a single pass: a
+    # tag's text is its strings joined by spaces, and once a tag's text fails
+    # both checks none of its descendants (substrings of it) can pass.
+    parser = PlodineTextParser()
+    parser.feed(html)
+    parser.close()
+    strings = parser.strings
+
+    sunday_counts = [0]
+    for text in strings:
+        sunday_counts.append(sunday_counts[-1] + any(word in text for word in PLODINE_SUNDAY_WORDS))
+
+    skip_until = 0
+    for start, end in parser.ranges:
+        if start < skip_until or sunday_counts[end] == sunday_counts[start]:
+            continue
+        text = ' '.join(strings[start:end])
+        if any(word in text for word in PLODINE_CLOSED_WORDS):
+            return False, 'Zatvoreno'
+        match = PLODINE_HOURS_RE.search(text)
+        if match:
+            from_time = match.group(1).replace('.', ':')
+            to_time = match.group(2).replace('.', ':')
+            return True, f'{from_time} - {to_time}'
+        skip_until = end
+    return None
+
+
+def check_plodine(stores_config, target_date=None):
     results = []
     plodine_stores = stores_config.get('plodine', [])
 
+    # The store page only lists the weekly hours
+    if not weekly_hours_apply(target_date or get_next_sunday().date()):
+        return [{'chain': 'PLODINE', 'name': store['name'], 'open': False, 'hours': 'Nema podataka'}
+                for store in plodine_stores]
+
     for my_store in plodine_stores:
         name = my_store['name']
         url = my_store['url']
 
         try:
-            print(f"Scraping Plodine HTML: {url}")
+            log_event(logging.DEBUG, "Checking", chain='plodine', store=url)
             # Add SSL verification disable and more robust headers
-            resp = requests.get(
-                url, 
+            html = fetch_source(
+                url,
+                parse=parse_text,
                 timeout=20, 
                 headers=HEADERS,
                 verify=False,  # SSL bypass
                 allow_redirects=True
             )
-            resp.raise_for_status()
 
-            soup = BeautifulSoup(resp.text, 'html.parser')
-            
-            # Find working hours section
-            hours_found = False
-            
-            # Plodine uses specific class or structure - look for opening hours
-            for tag in soup.find_all(['div', 'table', 'ul', 'li', 'p', 'span', 'td']):
-                text = tag.get_text(separator=' ', strip=True)
-                
-                if 'Nedjelja' in text or 'nedjelja' in text or 'NEDJELJA' in text:
-                    # Check if closed
-                    if 'Zatvoreno' in text or 'zatvoreno' in text or 'ZATVORENO' in text:
-                        results.append({
-                            'chain': 'PLODINE',
-                            'name': name,
-                            'open': False,
-                            'hours': 'Zatvoreno'
-                        })
-                        hours_found = True
-                        break
-                    else:
-                        # Try to find hours near Sunday
-                        match = re.search(r'(\d{1,2}[:.]\d{2})\s*[-–—]\s*(\d{1,2}[:.]\d{2})', text)
-                        if match:
-                            from_time = match.group(1).replace('.', ':')
-                            to_time = match.group(2).replace('.', ':')
-                            results.append({
-                                'chain': 'PLODINE',
-                                'name': name,
-                                'open': True,
-                                'hours': f'{from_time} - {to_time}'
-                            })
-                            hours_found = True
-                            break
-            
-            if not hours_found:
+            sunday = find_plodine_sunday(html)
+            if sunday is not None:
+                is_open, hours = sunday
+                results.append({
+                    'chain': 'PLODINE',
+                    'name': name,
+                    'open': is_open,
+                    'hours': hours
+                })
+            else:
                 # Default: closed if we can't find info
                 results.append({
                     'chain': 'PLODINE',
@@ -633,7 +2044,7 @@ def check_plodine(stores_config):
                 })
 
         except requests.exceptions.SSLError as e:
-            print(f"Plodine SSL error for {url}: {e}")
+            log_event(logging.WARNING, "SSL error", chain='plodine', store=url, error=e)
             results.append({
                 'chain': 'PLODINE',
                 'name': name,
@@ -641,7 +2052,7 @@ def check_plodine(stores_config):
                 'hours': 'SSL greška'
             })
         except requests.exceptions.Timeout as e:
-            print(f"Plodine timeout for {url}: {e}")
+            log_event(logging.WARNING, "Timeout", chain='plodine', store=url, error=e)
             results.append({
                 'chain': 'PLODINE',
                 'name': name,
@@ -649,9 +2060,7 @@ def check_plodine(stores_config):
                 'hours': 'Timeout'
             })
         except Exception as e:
-            print(f"Plodine scrape error for {url}: {e}")
-            import traceback
-            traceback.print_exc()
+            log_error("Check failed", e, chain='plodine', store=url)
             results.append({
                 'chain': 'PLODINE',
                 'name': name,
@@ -661,7 +2070,90 @@ def check_plodine(stores_config):
 
     return results
 
-def check_lidl(stores_config):
+# Wrappers devalue puts around a value, e.g. ["ShallowReactive", 12]
+NUXT_WRAPPERS = {'Reactive', 'ShallowReactive', 'Ref', 'ShallowRef'}
+# Negative "references" devalue uses for constants
+NUXT_CONSTANTS = {-1: None, -2: None, -3: float('nan'), -4: float('inf'), -5: float('-inf'), -6: -0.0}
+
+
+class NuxtPayload:
+    # Rehydrates a devalue-flattened Nuxt _payload.json on demand. Ints inside
+    # containers are indexes into the flat array; each index is rehydrated at
+    # most once and shared by everything that points at it. Indexes outside
+    # the (possibly truncated, see parse_nuxt_payload_stream) array stay ints.
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.memo = {}
+
+    def resolve(self, ref):
+        if isinstance(ref, bool) or not isinstance(ref, int):
+            return ref
+        if ref < 0:
+            return NUXT_CONSTANTS.get(ref, ref)
+        if ref >= len(self.payload):
+            return ref
+        if ref in self.memo:
+            return self.memo[ref]
+        return self.hydrate(ref, self.payload[ref])
+
+    def hydrate(self, ref, value):
+        if isinstance(value, dict):
+            result = {}
+            self.memo[ref] = result
+            for key, child in value.items():
+                result[key] = self.resolve(child)
+        elif isinstance(value, list):
+            if value and isinstance(value[0], str):
+                tag = value[0]
+                if tag in NUXT_WRAPPERS and len(value) > 1:
+                    result = self.resolve(value[1])
+                elif tag == 'Date' and len(value) > 1:
+                    result = value[1]
+                else:
+                    result = [self.resolve(child) for child in value[1:]]
+                self.memo[ref] = result
+                return result
+            result = []
+            self.memo[ref] = result
+            result.extend(self.resolve(child) for child in value)
+        else:
+            result = value
+            self.memo[ref] = result
+        return result
+
+    def opening_hours(self):
+        # openingHours of the first element that has one
+        for index, item in enumerate(self.payload):
+            if isinstance(item, dict) and 'openingHours' in item:
+                value = item['openingHours']
+                if isinstance(value, dict):
+                    return self.hydrate(('inline', index), value)
+                return self.resolve(value)
+        return None
+
+
+def build_lidl_index(payload):
+    # Date string -> rehydrated opening-hours item (first one per date), or
+    # None when the payload has no opening hours
+    opening_hours = NuxtPayload(payload).opening_hours()
+    if not opening_hours or not isinstance(opening_hours, dict) or 'items' not in opening_hours:
+        return None
+    items = opening_hours['items']
+    if not isinstance(items, list):
+        raise Exception("Unexpected opening hours items in payload")
+    hours_by_date = {}
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        item_date = item.get('date')
+        if isinstance(item_date, str) and item_date not in hours_by_date:
+            hours_by_date[item_date] = item
+    return hours_by_date
+
+
+def check_lidl(stores_config, target_date=None):
+    target_date = target_date or get_next_sunday().date()
     results = []
     lidl_stores = stores_config.get('lidl', [])
 
@@ -670,71 +2162,30 @@ def check_lidl(stores_config):
         name = my_store['name']
         
         try:
-            print(f"Checking Lidl {name} via _payload.json...")
+            log_event(logging.DEBUG, "Checking", chain='lidl', store=name)
             
             # Construct payload URL
             if not store_url.endswith('/'):
                 store_url += '/'
             payload_url = store_url + '_payload.json'
             
-            response = requests.get(payload_url, headers=HEADERS, timeout=15)
-            response.raise_for_status()
-            payload = response.json()
-            
-            print(f"Lidl: Got payload with {len(payload)} elements")
-            
-            # Search for openingHours in payload
-            opening_hours_ref = None
-            opening_hours_data = None
-            
-            for idx, item in enumerate(payload):
-                if isinstance(item, dict) and 'openingHours' in item:
-                    opening_hours_ref = item['openingHours']
-                    
-                    if isinstance(opening_hours_ref, dict):
-                        opening_hours_data = opening_hours_ref
-                    elif isinstance(opening_hours_ref, int) and 0 <= opening_hours_ref < len(payload):
-                        opening_hours_data = payload[opening_hours_ref]
-                    break
+            if STREAM_PARSE:
+                payload = fetch_source(payload_url, parse=parse_nuxt_payload_stream, headers=HEADERS, timeout=15, stream=True)
+            else:
+                payload = fetch_source(payload_url, headers=HEADERS, timeout=15)
             
-            if not opening_hours_data or not isinstance(opening_hours_data, dict) or 'items' not in opening_hours_data:
+            hours_by_date = indexed_source(payload_url, payload, build_lidl_index)
+            if hours_by_date is None:
                 raise Exception("No opening hours data in payload")
             
-            today = datetime.now()
-            days_until_sunday = (6 - today.weekday()) % 7
-            if days_until_sunday == 0:
-                days_until_sunday = 7
-            next_sunday = today + timedelta(days=days_until_sunday)
-            sunday_date_str = next_sunday.strftime('%Y-%m-%d')
-            
-            print(f"Lidl: Looking for Sunday: {sunday_date_str}")
-            
-            items = opening_hours_data['items']
+            sunday_date_str = target_date.strftime('%Y-%m-%d')
             
-            # items might be a reference
-            if isinstance(items, int) and 0 <= items < len(payload):
-                items = payload[items]
+            log_event(logging.DEBUG, "Payload fetched", chain='lidl', store=name, elements=len(payload), date=sunday_date_str)
             
-            sunday_hours = None
-            for item in items:
-                # item might be a reference
-                if isinstance(item, int) and 0 <= item < len(payload):
-                    item = payload[item]
-                
-                if isinstance(item, dict):
-                    item_date = item.get('date')
-                    
-                    # RESOLVE DATE REFERENCE
-                    if isinstance(item_date, int) and 0 <= item_date < len(payload):
-                        item_date = payload[item_date]
-                    
-                    if item_date == sunday_date_str:
-                        sunday_hours = item
-                        print(f"Lidl: Found Sunday data!")
-                        break
+            sunday_hours = hours_by_date.get(sunday_date_str)
             
             if not sunday_hours:
-                print(f"Lidl {name}: Sunday data not found in payload")
+                log_event(logging.DEBUG, "Date not in payload", chain='lidl', store=name, date=sunday_date_str)
                 results.append({
                     'chain': 'LIDL',
                     'name': name,
@@ -745,30 +2196,14 @@ def check_lidl(stores_config):
             
             time_ranges = sunday_hours.get('timeRanges', [])
             
-            # time_ranges might be a reference
-            if isinstance(time_ranges, int) and 0 <= time_ranges < len(payload):
-                time_ranges = payload[time_ranges]
-            
             if isinstance(time_ranges, list) and len(time_ranges) > 0:
                 time_range = time_ranges[0]
-                
-                # time_range might be a reference
-                if isinstance(time_range, int) and 0 <= time_range < len(payload):
-                    time_range = payload[time_range]
-                
                 from_time = time_range.get('from', '')
                 to_time = time_range.get('to', '')
                 
-                # Resolve time references
-                if isinstance(from_time, int) and 0 <= from_time < len(payload):
-                    from_time = payload[from_time]
-                if isinstance(to_time, int) and 0 <= to_time < len(payload):
-                    to_time = payload[to_time]
-                
                 from_hm = from_time.split('T')[1][:5] if 'T' in str(from_time) else ''
                 to_hm = to_time.split('T')[1][:5] if 'T' in str(to_time) else ''
                 
-                print(f"Lidl {name}: Sunday hours {from_hm} - {to_hm}")
                 results.append({
                     'chain': 'LIDL',
                     'name': name,
@@ -776,7 +2211,6 @@ def check_lidl(stores_config):
                     'hours': f'{from_hm} - {to_hm}'
                 })
             else:
-                print(f"Lidl {name}: Closed on Sunday")
                 results.append({
                     'chain': 'LIDL',
                     'name': name,
@@ -785,9 +2219,7 @@ def check_lidl(stores_config):
                 })
                 
         except Exception as e:
-            print(f"Lidl error for {name}: {e}")
-            import traceback
-            traceback.print_exc()
+            log_error("Check failed", e, chain='lidl', store=name)
             results.append({
                 'chain': 'LIDL',
                 'name': name,
@@ -802,39 +2234,387 @@ def check_lidl(stores_config):
 
 
 
-def fetch_fresh_data(user='josip'):
-    print(f"=== FETCHING FRESH DATA FOR {user.upper()} ===")
-    next_sunday = get_next_sunday()
-    
-    stores_config = JOSIP_STORES if user == 'josip' else NINA_STORES
+# (config key, checker, chain label, bulk) in the order results are collected.
+# Bulk checkers download one list for all stores, so they run as a single task.
+CHECKERS = [
+    ('spar', check_spar, 'SPAR', True),
+    ('lidl', check_lidl, 'LIDL', False),
+    ('konzum', check_konzum, 'KONZUM', True),
+    ('kaufland', check_kaufland, 'KAUFLAND', False),
+    ('studenac', check_studenac, 'STUDENAC', False),
+    ('dm', check_dm, 'DM', False),
+    ('muller', check_muller, 'MÜLLER', False),
+    ('plodine', check_plodine, 'PLODINE', False)
+]
+
+# The field that tells one store of a chain apart from another
+STORE_ID_FIELDS = {
+    'spar': 'id',
+    'lidl': 'url',
+    'konzum': 'id',
+    'kaufland': 'id',
+    'studenac': 'url',
+    'dm': 'storeId',
+    'muller': 'storeId',
+    'plodine': 'url'
+}
+
+fetch_executor = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix='fetch')
+# Whole-user refreshes run here so they never starve the per-store fetch pool
+refresh_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='refresh')
+inflight_refreshes = {}
+# key -> {'rows': store rows finished so far, 'listeners': queues of streaming requests}
+refresh_progress = {}
+# Per chain: free fetch slots, and tasks waiting for one as (future, fn, args).
+# A waiting task holds no fetch_executor worker.
+chain_slots = {key: CHAIN_CONCURRENCY.get(key, 1) for key, _, _, _ in CHECKERS}
+chain_waiting = {key: deque() for key, _, _, _ in CHECKERS}
+chain_slots_lock = Lock()
+# Row hours the checkers report when a store could not be checked
+FAILED_HOURS = ('Greška', 'Greska', 'Timeout', 'SSL greška')
+# (store token, date) -> (last row that was not a failure, when it was fetched)
+last_good = {}
+last_good_lock = Lock()
+
+
+def is_failed_row(row):
+    return row['hours'].startswith(FAILED_HOURS)
+
+
+def remember_good_rows(rows, target_date):
+    # Batch rows are named by store token, so they are shared by every user
+    now = datetime.now()
+    good = [row for row in rows if not is_failed_row(row) and 'stale_since' not in row]
+    with last_good_lock:
+        for row in good:
+            last_good[(row['name'], target_date)] = (row, now)
+        for key in [key for key in last_good if key[1] < now.date()]:
+            del last_good[key]
+    last_good_store(target_date, good, now)
+
+
+def fill_stale_rows(rows, target_date):
+    # Failed rows -> the store's last good row for the date, marked with when
+    # it was fetched. Stores never seen working keep their error.
+    failed = [row['name'] for row in rows if is_failed_row(row)]
+    if not failed:
+        return rows
+    with last_good_lock:
+        known = {name: last_good[(name, target_date)] for name in failed if (name, target_date) in last_good}
+    loaded = last_good_load(target_date, [name for name in failed if name not in known])
+    if loaded:
+        with last_good_lock:
+            for name, good in loaded.items():
+                last_good.setdefault((name, target_date), good)
+        known.update(loaded)
+
+    filled = []
+    for row in rows:
+        good = known.get(row['name']) if is_failed_row(row) else None
+        if good is None:
+            filled.append(row)
+            continue
+        good_row, timestamp = good
+        filled.append(dict(good_row, stale_since=timestamp.strftime('%d.%m.%Y %H:%M'), error=row['hours']))
+        count_metric('trgovine_stale_rows_total', chain=good_row['chain'])
+    return filled
+
+
+def result_ttl(data):
+    # None (the full CACHE_DURATION_HOURS) unless some rows are errors or stale
+    if any(is_failed_row(row) or 'stale_since' in row for row in data['stores']):
+        return DEGRADED_CACHE_MINUTES * 60
+    return None
+
+
+def plan_fetch_tasks(stores_config):
+    tasks = []
+    for key, checker, label, bulk in CHECKERS:
+        stores = stores_config.get(key, [])
+        if not stores:
+            continue
+        if bulk:
+            tasks.append((key, checker, label, stores))
+        else:
+            for store in stores:
+                tasks.append((key, checker, label, [store]))
+    return tasks
+
+
+def run_checker(key, checker, stores_config, target_date=None):
+    # Times the checker, splitting off what it spent waiting on upstreams
+    scope = {'chain': key, 'network': 0.0}
+    token = metrics_scope.set(scope)
+    start = time.perf_counter()
+    try:
+        return checker(stores_config, target_date)
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics_scope.reset(token)
+        observe_metric('trgovine_checker_seconds', elapsed, chain=key)
+        observe_metric('trgovine_checker_parse_seconds', max(elapsed - scope['network'], 0), chain=key)
+        log_event(
+            logging.DEBUG, "Checker done", chain=key, stores=len(stores_config.get(key, [])),
+            duration_ms=round(elapsed * 1000), network_ms=round(scope['network'] * 1000)
+        )
+
+
+def submit_fetch(key, fn, *args):
+    # Runs fn on fetch_executor once the chain is under its CHAIN_CONCURRENCY
+    # cap; until then the returned future waits in chain_waiting
+    future = Future()
+    with chain_slots_lock:
+        if chain_slots[key] == 0:
+            chain_waiting[key].append((future, fn, args))
+            return future
+        chain_slots[key] -= 1
+    future.set_running_or_notify_cancel()
+    fetch_executor.submit(run_fetch_slot, key, future, fn, args)
+    return future
+
+
+def run_fetch_slot(key, future, fn, args):
+    try:
+        future.set_result(fn(*args))
+    except BaseException as e:
+        future.set_exception(e)
+    finally:
+        release_fetch_slot(key)
+
 
+def release_fetch_slot(key):
+    # Hands the slot to the next waiting task that wasn't cancelled meanwhile
+    while True:
+        with chain_slots_lock:
+            if not chain_waiting[key]:
+                chain_slots[key] += 1
+                return
+            future, fn, args = chain_waiting[key].popleft()
+        if future.set_running_or_notify_cancel():
+            fetch_executor.submit(run_fetch_slot, key, future, fn, args)
+            return
+
+
+def failed_rows(label, stores, hours):
+    return [{'chain': label, 'name': store['name'], 'open': False, 'hours': hours} for store in stores]
+
+
+def task_rows(label, stores, future):
+    try:
+        return future.result()
+    except Exception as e:
+        log_event(logging.WARNING, "Task failed", chain=label, error=e)
+        return failed_rows(label, stores, f'Greška: {str(e)[:30]}')
+
+
+def run_checkers(stores_config, stagger=0, on_rows=None, target_date=None):
+    # on_rows, if given, is called with each batch of store rows as soon as it is known
+    if FETCH_MODE != 'parallel':
+        results = []
+        for key, checker, _, _ in CHECKERS:
+            if not stores_config.get(key):
+                continue
+            rows = run_checker(key, checker, stores_config, target_date)
+            if on_rows and rows:
+                on_rows(rows)
+            results.extend(rows)
+        return results
+
+    tasks = plan_fetch_tasks(stores_config)
+    collected = [None] * len(tasks)
+    collect_lock = Lock()
+
+    def collect(index, rows):
+        # First result for a task wins, so a fetch finishing after the deadline is dropped
+        with collect_lock:
+            if collected[index] is not None:
+                return
+            collected[index] = rows
+        if on_rows and rows:
+            on_rows(rows)
+
+    # Optionally start each chain `stagger` seconds after the previous one.
+    # The wait happens here before submitting, so no fetch worker sits idle.
+    chain_order = list(dict.fromkeys(key for key, _, _, _ in tasks))
+    started = time.monotonic()
+    futures = []
+    for index, (key, checker, label, stores) in enumerate(tasks):
+        delay = started + chain_order.index(key) * stagger - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        # Each task runs in a copy of the caller's context so it reports into the same trace
+        future = submit_fetch(key, copy_context().run, run_checker, key, checker, {key: stores}, target_date)
+        future.add_done_callback(
+            lambda f, index=index, label=label, stores=stores: collect(index, task_rows(label, stores, f))
+        )
+        futures.append(future)
+
+    deadline = FETCH_DEADLINE_SECONDS + stagger * max(len(chain_order) - 1, 0)
+    done, not_done = wait(futures, timeout=max(started + deadline - time.monotonic(), 0))
+    if not_done:
+        log_event(logging.WARNING, "Fetch deadline hit", deadline_s=deadline, unfinished=len(not_done))
+
+    for index, ((key, _, label, stores), future) in enumerate(zip(tasks, futures)):
+        if future in done:
+            # wait() can return before the done callback has run
+            collect(index, task_rows(label, stores, future))
+        else:
+            collect(index, failed_rows(label, stores, 'Timeout'))
+            count_metric('trgovine_fetch_deadline_exceeded_total', chain=key)
+            future.cancel()
+
+    # Collect in task order so the pre-sort ordering matches the sequential mode
     results = []
-    results.extend(check_spar(stores_config))
-    results.extend(check_lidl(stores_config))
-    results.extend(check_konzum(stores_config))
-    results.extend(check_kaufland(stores_config))
-    results.extend(check_studenac(stores_config))
-    results.extend(check_dm(stores_config))
-    results.extend(check_muller(stores_config))
-    results.extend(check_plodine(stores_config))
+    for rows in collected:
+        results.extend(rows)
+    return results
 
-    print(f"Total stores: {len(results)}")
 
+def plan_batch(users):
+    # Merges the users' store lists so every distinct store is checked once.
+    # Each merged store is named by its id so rows can be routed back;
+    # returns (stores_config, {(chain, id): [(user, name), ...]}).
+    stores_config = {}
+    owners = {}
+    for user in users:
+        for key, stores in USER_STORES[resolve_user(user)].items():
+            for store in stores:
+                target = f"{key}:{store[STORE_ID_FIELDS[key]]}"
+                if target not in owners:
+                    owners[target] = []
+                    stores_config.setdefault(key, []).append(dict(store, name=target))
+                owners[target].append((user, store['name']))
+    return stores_config, owners
+
+
+def split_rows(rows, owners):
+    # Batch rows -> {user: rows} under each user's own store names
+    by_user = {}
+    for row in rows:
+        for user, name in owners.get(row['name'], []):
+            by_user.setdefault(user, []).append(dict(row, name=name))
+    return by_user
+
+
+def result_data(results, target_date):
     results.sort(key=lambda x: (not x['open'], x['chain'], x['name']))
-
-    return {
+    data = {
         'success': True,
-        'date': next_sunday.strftime('%d.%m.%Y'),
-        'day': 'Nedjelja',
+        'date': target_date.strftime('%d.%m.%Y'),
+        'day': CROATIAN_DAYS[target_date.weekday()],
         'stores': results,
         'summary': {
             'open': len([s for s in results if s['open']]),
-            'closed': len([s for s in results if not s['open']]),
+            'closed': len([s for s in results if not s['open'] and not s.get('pending')]),
             'total': len(results)
-        },
-        'cached': False,
-        'last_update': datetime.now().strftime('%H:%M')
+        }
     }
+    holiday = holiday_name(target_date)
+    if holiday:
+        data['holiday'] = holiday
+    return data
+
+
+def fetch_fresh_batch(users, stagger=0, on_rows=None, target_date=None):
+    # on_rows, if given, is called as on_rows(user, rows)
+    target_date = target_date or get_next_sunday().date()
+    stores_config, owners = plan_batch(users)
+
+    def publish(rows):
+        for user, user_rows in split_rows(fill_stale_rows(rows, target_date), owners).items():
+            on_rows(user, user_rows)
+
+    trace = []
+    token = source_cache_trace.set(trace)
+    start = time.perf_counter()
+    try:
+        rows = run_checkers(stores_config, stagger, publish if on_rows else None, target_date)
+    finally:
+        source_cache_trace.reset(token)
+        elapsed = time.perf_counter() - start
+        observe_metric('trgovine_refresh_seconds', elapsed)
+
+    rows = fill_stale_rows(rows, target_date)
+    remember_good_rows(rows, target_date)
+    by_user = split_rows(rows, owners)
+    last_update = datetime.now().strftime('%H:%M')
+    batch = {}
+    for user in users:
+        data = result_data(by_user.get(user, []), target_date)
+        data.update(cached=False, source_cache_hits=sorted(set(trace)), last_update=last_update)
+        batch[user] = data
+    log_event(
+        logging.INFO, "Refresh done", users=','.join(users), date=target_date.isoformat(), stores=len(owners),
+        rows=len(rows), source_cache_hits=len(set(trace)), duration_ms=round(elapsed * 1000)
+    )
+    return batch
+
+
+def fetch_fresh_data(user='josip', stagger=0, on_rows=None, target_date=None):
+    callback = (lambda _, rows: on_rows(rows)) if on_rows else None
+    return fetch_fresh_batch([user], stagger, callback, target_date)[user]
+
+
+def acquire_scheduler_lock():
+    # Only the gunicorn worker holding this lock runs scheduled refreshes. The
+    # file stays open (and locked) for the life of the process.
+    try:
+        import fcntl
+    except ImportError:
+        return True
+    lock_file = open(SCHEDULER_LOCK_PATH, 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+def scheduler_interval(now):
+    if now.weekday() in (5, 6) and SCHEDULE_PEAK_HOURS[0] <= now.hour < SCHEDULE_PEAK_HOURS[1]:
+        return SCHEDULE_PEAK_INTERVAL_MINUTES * 60
+    return SCHEDULE_INTERVAL_MINUTES * 60
+
+
+def seconds_until_next_run():
+    now = datetime.now()
+    # Wake up right after get_next_sunday() rolls over so the new week is warm too
+    rollover = datetime.combine(get_next_sunday().date(), dt_time.min)
+    return max(min(scheduler_interval(now), (rollover - now).total_seconds() + 1), 1)
+
+
+def run_scheduled_refresh():
+    warm_up_connections()
+    # One batch for everyone, so stores shared between users are fetched once
+    with cache_lock:
+        futures = start_batch_refresh([(cache_key(user), user) for user in USER_STORES], SCHEDULE_CHAIN_STAGGER_SECONDS)
+    for (user, _), future in futures.items():
+        try:
+            future.result()
+            log_event(logging.DEBUG, "Scheduled refresh done", user=user)
+        except Exception as e:
+            log_event(logging.WARNING, "Scheduled refresh failed", user=user, error=e)
+
+
+def scheduler_loop():
+    lock = None
+    while True:
+        if lock is None:
+            lock = acquire_scheduler_lock()
+        if lock is not None:
+            try:
+                run_scheduled_refresh()
+            except Exception as e:
+                log_error("Scheduler error", e)
+        time.sleep(seconds_until_next_run())
+
+
+def start_scheduler():
+    if not SCHEDULER_ENABLED:
+        return
+    Thread(target=scheduler_loop, name='scheduler', daemon=True).start()
+
 
 
 HTML_TEMPLATE = '''<!DOCTYPE html>
@@ -884,6 +2664,7 @@ h1{color:#333;font-size:1.8em;margin-bottom:5px}
 .store-hours{font-size:0.9em;padding:4px 10px;border-radius:12px;display:inline-block;margin-top:4px}
 .store-hours.open{background:#4CAF50;color:white}
 .store-hours.closed{background:#f44336;color:white}
+.store-stale{display:block;font-size:0.75em;color:#999;margin-top:4px}
 .loading{text-align:center;padding:40px;color:#666}
 .spinner{border:3px solid #f3f3f3;border-top:3px solid #667eea;border-radius:50%;width:40px;height:40px;animation:spin 1s linear infinite;margin:0 auto 15px}
 @keyframes spin{0%{transform:rotate(0deg)}100%{transform:rotate(360deg)}}
@@ -920,47 +2701,428 @@ h1{color:#333;font-size:1.8em;margin-bottom:5px}
 <h1>🛒 Radi li u nedjelju?</h1>
 <p class="subtitle">Moje trgovine u Zagrebu</p>
 <div class="user-toggle">
-  <button class="toggle-btn" data-user="josip">Josip</button>
-  <button class="toggle-btn" data-user="nina">Nina</button>
+{%- for name in users %}
+  <button class="toggle-btn" data-user="{{ name }}">{{ name|capitalize }}</button>
+{%- endfor %}
+</div>
+<div id="results">
+{%- if result %}
+<div class="date-banner">📅 {{ result.day }}, {{ result.date }}</div>
+<div id="cache-info" class="cache-info cached">{% if result.stale %}⏳ Stariji podaci ({{ result.last_update }}), osvježavam u pozadini{% else %}💾 Cached podaci ({{ result.last_update }}){% endif %}</div>
+<div id="summary"><div class="summary"><div class="summary-card open"><div class="number">{{ result.summary.open }}</div><div class="label">RADI</div></div><div class="summary-card closed"><div class="number">{{ result.summary.closed }}</div><div class="label">ZATVORENO</div></div></div></div>
+<div id="stores">
+{%- for store in result.stores %}
+<div class="store"><div class="store-icon">{{ '✅' if store.open else '❌' }}</div><div class="store-info"><div class="store-chain">{{ store.chain }}</div><div class="store-name">{{ store.name }}</div><span class="store-hours {{ 'open' if store.open else 'closed' }}">{{ store.hours }}</span>
+{%- if store.stale_since %}<span class="store-stale">⏳ Podaci od {{ store.stale_since }}, stranica trenutno ne odgovara</span>{% endif %}</div></div>
+{%- endfor %}
+</div>
+{%- else %}<div class="loading"><div class="spinner"></div>Učitavam podatke...</div>{% endif -%}
 </div>
-<div id="results"><div class="loading"><div class="spinner"></div>Učitavam podatke...</div></div>
 <button class="refresh-btn" onclick="loadData()">🔄 Osvježi podatke</button>
 </div>
 <div class="footer">Podaci se cachiraju 6 sati</div>
-<script src="/static/app.js?v=__VERSION__"></script>
+<script id="initial-data" type="application/json">{{ result|tojson }}</script>
+<script src="__APP_JS__"></script>
 </body>
 </html>'''
 
+INDEX_TEMPLATE = app.jinja_env.from_string(HTML_TEMPLATE.replace('__APP_JS__', asset_url('app.js')))
+
+
 @app.route('/')
 def index():
-    return render_template_string(HTML_TEMPLATE.replace('__VERSION__', STATIC_VERSION))
+    # A warm result for the user (remembered in a cookie by app.js) is
+    # rendered into the page and embedded for app.js, so the first paint
+    # needs no /api/check round trip. Otherwise the refresh starts now and
+    # app.js joins it.
+    user = resolve_user(request.args.get('user') or request.cookies.get('user', 'josip'))
+    key = cache_key(user)
+    cache_sync_from_disk([key])
+    with cache_lock:
+        entry, state = cache_lookup(key)
+        if state != 'fresh':
+            start_refresh(key, user)
+    result = None
+    if entry is not None:
+        result = dict(entry['data'], cached=True, user=user)
+        if state == 'stale':
+            result['stale'] = True
+    return INDEX_TEMPLATE.render(result=result, users=USER_STORES)
+
+def metric_line(name, labels, value):
+    if labels:
+        escaped = ','.join(
+            '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for k, v in labels
+        )
+        name = f"{name}{{{escaped}}}"
+    return f"{name} {value}"
+
+
+def render_metrics():
+    with metrics_lock:
+        series = {key: (dict(value, buckets=list(value['buckets'])) if isinstance(value, dict) else value)
+                  for key, value in metrics.items()}
+    lines = []
+    for name, (help_text, buckets) in METRIC_HISTOGRAMS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} histogram")
+        for (series_name, labels), value in sorted(series.items()):
+            if series_name != name:
+                continue
+            for bound, bucket_count in zip(buckets, value['buckets']):
+                lines.append(metric_line(f"{name}_bucket", labels + (('le', str(bound)),), bucket_count))
+            lines.append(metric_line(f"{name}_bucket", labels + (('le', '+Inf'),), value['count']))
+            lines.append(metric_line(f"{name}_sum", labels, round(value['sum'], 6)))
+            lines.append(metric_line(f"{name}_count", labels, value['count']))
+    for name, help_text in METRIC_COUNTERS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} counter")
+        for (series_name, labels), value in sorted(series.items()):
+            if series_name == name:
+                lines.append(metric_line(name, labels, value))
+
+    # Counters the cache and source layers already keep
+    cache = cache_info()
+    lines.append("# HELP trgovine_cache_lookups_total Result cache lookups by outcome")
+    lines.append("# TYPE trgovine_cache_lookups_total counter")
+    for result, field in (('hit', 'hits'), ('miss', 'misses'), ('stale', 'stale')):
+        lines.append(metric_line('trgovine_cache_lookups_total', (('result', result),), cache[field]))
+    for name, field, kind, help_text in (
+        ('trgovine_cache_coalesced_total', 'coalesced', 'counter', 'Requests that joined an in-flight refresh'),
+        ('trgovine_cache_evictions_total', 'evictions', 'counter', 'Result cache LRU evictions'),
+        ('trgovine_cache_entries', 'size', 'gauge', 'Entries in the result cache'),
+        ('trgovine_refreshes_inflight', 'inflight', 'gauge', 'Refreshes currently running')
+    ):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.append(metric_line(name, (), cache[field]))
+    transfer = source_cache_info()['transfer']
+    for name, field, help_text in (
+        ('trgovine_source_requests_total', 'requests', 'Upstream documents fetched or revalidated'),
+        ('trgovine_source_not_modified_total', 'not_modified', 'Upstream documents answered with 304'),
+        ('trgovine_source_unchanged_total', 'unchanged', 'Upstream documents whose body hash was unchanged'),
+        ('trgovine_source_received_bytes_total', 'bytes_received', 'Upstream body bytes received'),
+        ('trgovine_source_saved_bytes_total', 'bytes_saved', 'Upstream body bytes saved by 304s')
+    ):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} counter")
+        lines.append(metric_line(name, (), transfer[field]))
+    lines.append("# HELP trgovine_upstream_breaker_state Host circuit breaker: 0 closed, 1 half-open, 2 open")
+    lines.append("# TYPE trgovine_upstream_breaker_state gauge")
+    for host, breaker in sorted(breaker_info().items()):
+        state = ('closed', 'half_open', 'open').index(breaker['state'])
+        lines.append(metric_line('trgovine_upstream_breaker_state', (('host', host),), state))
+    return '\n'.join(lines) + '\n'
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.route('/api/stats')
+def stats():
+    return jsonify({
+        'http': http_pool_stats(),
+        'cache': cache_info(),
+        'sources': source_cache_info(),
+        'breakers': breaker_info()
+    })
+
+def requested_date():
+    # ?date=YYYY-MM-DD, None (the next Sunday) when absent
+    value = request.args.get('date')
+    if not value:
+        return None
+    target_date = datetime.strptime(value, '%Y-%m-%d').date()
+    if target_date <= datetime.now().date():
+        raise ValueError('date must be in the future')
+    if not is_target_date(target_date):
+        raise ValueError('date must be a Sunday or a public holiday')
+    # Same horizon as /api/upcoming; past it no source has hours to give
+    if target_date > get_next_sunday().date() + timedelta(weeks=UPCOMING_MAX_WEEKS - 1):
+        raise ValueError(f'date must be within the next {UPCOMING_MAX_WEEKS} weeks')
+    return target_date
+
+
+def requested_budget():
+    # ?budget_ms=N -> seconds, None (wait for the whole refresh) when absent
+    value = request.args.get('budget_ms')
+    if not value:
+        return None
+    try:
+        budget_ms = int(value)
+    except ValueError:
+        raise ValueError('budget_ms must be a number')
+    if budget_ms < 0:
+        raise ValueError('budget_ms must not be negative')
+    return min(budget_ms, CHECK_BUDGET_MAX_MS) / 1000
+
+
+def partial_result(key, user, future):
+    # The rows an unfinished refresh has published so far, plus a pending
+    # row for every store still being checked. The refresh keeps going and
+    # lands in the cache, so asking again fills the gaps.
+    with cache_lock:
+        progress = refresh_progress.get(key)
+        rows = list(progress['rows']) if progress is not None else None
+    if rows is None:
+        # Progress is dropped just before the future resolves
+        return future.result()
+
+    resolved = {(row['chain'], row['name']) for row in rows}
+    for config_key, _, label, _ in CHECKERS:
+        for store in USER_STORES[user].get(config_key, []):
+            if (label, store['name']) not in resolved:
+                rows.append({'chain': label, 'name': store['name'], 'open': False, 'hours': 'Provjeravam...', 'pending': True})
+    data = result_data(rows, key[1])
+    pending = len(rows) - len(resolved)
+    data['summary']['pending'] = pending
+    data.update(cached=False, partial=True, retry_after_ms=PARTIAL_RETRY_MS, last_update=datetime.now().strftime('%H:%M'))
+    log_event(logging.DEBUG, "Partial result", user=user, date=key[1].isoformat(), pending=pending)
+    return data
+
+
+def budgeted_result(key, user, future, deadline):
+    # future's result if it arrives before deadline (time.monotonic()), else a partial one
+    if deadline is None:
+        return future.result()
+    try:
+        return future.result(timeout=max(deadline - time.monotonic(), 0))
+    except FutureTimeout:
+        return partial_result(key, user, future)
+
+
+def prepare_body(data):
+    # Serialised exactly as jsonify would, with a content hash for the ETag
+    body = app.json.response(data).get_data()
+    return {'body': body, 'etag': hashlib.sha1(body).hexdigest()[:20], 'encoded': {}}
+
+
+def cached_body(entry, state):
+    # The cache entry's answer for a fresh or stale hit, serialised once per
+    # entry (a refresh puts a new entry)
+    bodies = entry.setdefault('bodies', {})
+    prepared = bodies.get(state)
+    if prepared is None:
+        result = dict(entry['data'], cached=True)
+        if state == 'stale':
+            result['stale'] = True
+        prepared = bodies.setdefault(state, prepare_body(result))
+    return prepared
+
+
+def encoded_body(prepared, encoding):
+    body = prepared['encoded'].get(encoding)
+    if body is None:
+        if encoding == 'br':
+            body = brotli.compress(prepared['body'], quality=11)
+        else:
+            body = gzip.compress(prepared['body'], compresslevel=9, mtime=0)
+        prepared['encoded'][encoding] = body
+    return body
+
+
+def cache_max_age(entry):
+    return max(int((entry['expires'] - datetime.now()).total_seconds()), 0)
+
+
+def json_response(prepared, max_age=None):
+    # max_age None: the client must revalidate (stale or partial answers)
+    response = Response(status=200, mimetype='application/json')
+    response.headers['ETag'] = f'W/"{prepared["etag"]}"'
+    response.headers['Cache-Control'] = f'public, max-age={max_age}' if max_age else 'no-cache'
+    response.headers['Vary'] = 'Accept-Encoding'
+    if request.if_none_match.contains_weak(prepared['etag']):
+        response.status_code = 304
+        return response
+
+    encoding = None
+    if len(prepared['body']) >= COMPRESS_MIN_BYTES:
+        for name in (('br', 'gzip') if brotli else ('gzip',)):
+            if request.accept_encodings[name] > 0:
+                encoding = name
+                break
+    if encoding:
+        response.set_data(encoded_body(prepared, encoding))
+        response.headers['Content-Encoding'] = encoding
+    else:
+        response.set_data(prepared['body'])
+    return response
+
+
+def cached_results(pairs):
+    # [(key, user)] -> (results the cache can answer, futures for the misses).
+    # Misses and stale entries are refreshed together in one batch per date.
+    cache_sync_from_disk([key for key, user in pairs])
+    with cache_lock:
+        results = {}
+        refresh = []
+        missing = []
+        for key, user in pairs:
+            entry, state = cache_lookup(key)
+            if state != 'fresh':
+                refresh.append((key, user))
+            if state == 'miss':
+                missing.append(key)
+                continue
+            result = entry['data'].copy()
+            result['cached'] = True
+            if state == 'stale':
+                result['stale'] = True
+            results[key] = result
+        futures = start_batch_refresh(refresh) if refresh else {}
+    return results, {key: futures[key] for key in missing}
+
 
 @app.route('/api/check')
 def check_all():
     user = request.args.get('user', 'josip')
-    print(f"=== API CHECK CALLED for {user} ===")
+    try:
+        target_date = requested_date()
+        budget = requested_budget()
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    deadline = time.monotonic() + budget if budget is not None else None
+
+    users = resolve_users(user)
+    if len(users) > 1:
+        try:
+            keys = {user: cache_key(user, target_date) for user in users}
+            results, futures = cached_results([(key, user) for user, key in keys.items()])
+            for key, future in futures.items():
+                results[key] = budgeted_result(key, key[0], future, deadline)
+            max_age = None
+            if not any(result.get('stale') or result.get('partial') for result in results.values()):
+                with cache_lock:
+                    entries = [cache.get(key) for key in keys.values()]
+                if all(entries):
+                    max_age = min(cache_max_age(entry) for entry in entries)
+            payload = {'success': True, 'users': {user: results[key] for user, key in keys.items()}}
+            return json_response(prepare_body(payload), max_age)
+        except Exception as e:
+            log_error("API check error", e, users=','.join(users))
+            return jsonify({'success': False, 'error': str(e)}), 500
     
     try:
+        user = users[0]
+        key = cache_key(user, target_date)
+        cache_sync_from_disk([key])
         with cache_lock:
-            if is_cache_valid() and cache.get('user') == user:
-                print("Cache is valid, returning cached data")
-                result = cache['data'].copy()
-                result['cached'] = True
-                return jsonify(result)
-            else:
-                print("Cache invalid or different user, fetching fresh data...")
-                data = fetch_fresh_data(user)
-                cache['data'] = data
-                cache['timestamp'] = datetime.now()
-                cache['date'] = get_next_sunday().date()
-                cache['user'] = user
-                print("Fresh data fetched successfully")
-                return jsonify(data)
+            entry, state = cache_lookup(key)
+            log_event(logging.DEBUG, "API check", user=user, status=state)
+            if state != 'fresh':
+                future = start_refresh(key, user)
+        if state == 'fresh':
+            return json_response(cached_body(entry, state), cache_max_age(entry))
+        if state == 'stale':
+            # With a budget, the refresh's result if it lands in time
+            if deadline is not None:
+                try:
+                    data = future.result(timeout=max(deadline - time.monotonic(), 0))
+                    with cache_lock:
+                        entry = cache.get(key)
+                    return json_response(prepare_body(data), cache_max_age(entry) if entry else None)
+                except FutureTimeout:
+                    pass
+                except Exception as e:
+                    # The stale entry is still a usable answer
+                    log_event(logging.WARNING, "Refresh failed, serving stale", user=user, error=e)
+            return json_response(cached_body(entry, state))
+
+        data = budgeted_result(key, user, future, deadline)
+        if data.get('partial'):
+            return json_response(prepare_body(data))
+        with cache_lock:
+            entry = cache.get(key)
+        return json_response(prepare_body(data), cache_max_age(entry) if entry else None)
+    except Exception as e:
+        log_error("API check error", e, user=user)
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/upcoming')
+def upcoming():
+    user = resolve_user(request.args.get('user', 'josip'))
+    try:
+        weeks = int(request.args.get('weeks', '4'))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'weeks must be a number'}), 400
+    weeks = min(max(weeks, 1), UPCOMING_MAX_WEEKS)
+
+    try:
+        keys = [cache_key(user, target_date) for target_date in upcoming_dates(weeks)]
+        results, futures = cached_results([(key, user) for key in keys])
+
+        # The refreshes share source_cache, so each upstream document is
+        # downloaded by whichever date gets to it first and reused by the rest
+        for key, future in futures.items():
+            results[key] = future.result()
+        return jsonify({'success': True, 'weeks': weeks, 'dates': [results[key] for key in keys]})
     except Exception as e:
-        print(f"API check error: {e}")
-        import traceback
-        traceback.print_exc()
+        log_error("API upcoming error", e, user=user, weeks=weeks)
         return jsonify({'success': False, 'error': str(e)}), 500
 
+
+def ndjson(frame):
+    return json.dumps(frame) + '\n'
+
+
+@app.route('/api/check/stream')
+def check_stream():
+    user = resolve_user(request.args.get('user', 'josip'))
+    try:
+        target_date = requested_date()
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    key = cache_key(user, target_date)
+
+    cache_sync_from_disk([key])
+    with cache_lock:
+        entry, state = cache_lookup(key)
+        if state == 'stale':
+            start_refresh(key, user)
+        if state == 'miss':
+            future = start_refresh(key, user)
+            rows_so_far, listener = subscribe_rows(key)
+
+    def generate():
+        if state != 'miss':
+            result = entry['data'].copy()
+            result['cached'] = True
+            if state == 'stale':
+                result['stale'] = True
+            yield ndjson({'type': 'start', 'date': result['date'], 'day': result['day'], 'cached': True})
+            for store in result['stores']:
+                yield ndjson({'type': 'store', 'store': store})
+            yield ndjson({'type': 'done', 'result': result})
+            return
+
+        yield ndjson({'type': 'start', 'date': key[1].strftime('%d.%m.%Y'), 'day': CROATIAN_DAYS[key[1].weekday()], 'cached': False})
+        for store in rows_so_far:
+            yield ndjson({'type': 'store', 'store': store})
+        while True:
+            rows = listener.get()
+            if rows is None:
+                break
+            for store in rows:
+                yield ndjson({'type': 'store', 'store': store})
+        try:
+            yield ndjson({'type': 'done', 'result': future.result()})
+        except Exception as e:
+            log_error("API stream error", e, user=user)
+            yield ndjson({'type': 'error', 'error': str(e)})
+
+    response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
 if __name__ == '__main__':
+    # With the debug reloader only the child process that serves requests schedules
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_scheduler()
     app.run(host='0.0.0.0', port=5000, debug=True)
+else:
+    start_scheduler()
@@ -1,4 +1,13 @@
 let currentUser = localStorage.getItem('selectedUser') || 'josip';
+// Lets the server render this user's stores into the page next time
+const rememberUser = user => { document.cookie = `user=${user}; path=/; max-age=31536000; samesite=lax`; };
+rememberUser(currentUser);
+// Render rows as each chain answers when the browser can read a streamed body
+const STREAMING = 'ReadableStream' in window && 'TextDecoder' in window;
+// The last complete result per user is kept here and shown at once on load and toggle
+const SAVED_PREFIX = 'result:';
+// What is on screen ({user, date, stores, partial}), so a newer result only redraws the rows that changed
+let shown = null;
 
 document.querySelectorAll('.toggle-btn').forEach(btn => {
   if (btn.dataset.user === currentUser) btn.classList.add('active');
@@ -6,30 +15,170 @@ document.querySelectorAll('.toggle-btn').forEach(btn => {
   btn.addEventListener('click', () => {
     currentUser = btn.dataset.user;
     localStorage.setItem('selectedUser', currentUser);
+    rememberUser(currentUser);
     document.querySelectorAll('.toggle-btn').forEach(b => b.classList.remove('active'));
     btn.classList.add('active');
     loadData();
   });
 });
 
+function saveResult(user,data){
+  // Only complete, current answers are worth showing again later
+  if(data.partial||data.stale)return;
+  try{localStorage.setItem(SAVED_PREFIX+user,JSON.stringify({data,savedAt:Date.now()}));}catch(e){}
+}
+
+function savedResult(user){
+  try{
+    const saved=JSON.parse(localStorage.getItem(SAVED_PREFIX+user));
+    const [day,month,year]=saved.data.date.split('.').map(Number);
+    // Once the day has passed the result is of no use
+    if(new Date(year,month-1,day+1)<=new Date())return null;
+    return saved;
+  }catch(e){return null;}
+}
+
+function ageText(ms){
+  const minutes=Math.round(ms/60000);
+  if(minutes<1)return 'upravo';
+  if(minutes<60)return `prije ${minutes} min`;
+  return `prije ${Math.round(minutes/60)} h`;
+}
+
+function storeHtml(store){
+  const icon=store.open?'✅':'❌';
+  const statusClass=store.open?'open':'closed';
+  // Filled from the last good check while the chain's site is failing
+  const stale=store.stale_since?`<span class="store-stale">⏳ Podaci od ${store.stale_since}, stranica trenutno ne odgovara</span>`:'';
+  return `<div class="store"><div class="store-icon">${icon}</div><div class="store-info"><div class="store-chain">${store.chain}</div><div class="store-name">${store.name}</div><span class="store-hours ${statusClass}">${store.hours}</span>${stale}</div></div>`;
+}
+
+function summaryHtml(open,closed){
+  return `<div class="summary"><div class="summary-card open"><div class="number">${open}</div><div class="label">RADI</div></div><div class="summary-card closed"><div class="number">${closed}</div><div class="label">ZATVORENO</div></div></div>`;
+}
+
+function cacheStatus(data){
+  return data.partial?`⏳ Još provjeravam ${data.summary.pending} trgovina...`:data.stale?`⏳ Stariji podaci (${data.last_update}), osvježavam u pozadini`:data.cached?`💾 Cached podaci (${data.last_update})`:`🔄 Osvježeno (${data.last_update})`;
+}
+
+function renderResult(data,status){
+  let html=`<div class="date-banner">📅 ${data.day}, ${data.date}</div><div id="cache-info" class="cache-info ${data.cached?'cached':''}">${status||cacheStatus(data)}</div><div id="summary">${summaryHtml(data.summary.open,data.summary.closed)}</div><div id="stores">`;
+  data.stores.forEach(store=>{html+=storeHtml(store);});
+  document.getElementById('results').innerHTML=html+'</div>';
+  shown={user:currentUser,date:data.date,stores:data.stores,partial:!!data.partial};
+}
+
+// Applies a result from the server on top of what is shown
+function showResult(user,data){
+  if(user!==currentUser)return;
+  saveResult(user,data);
+  const rows=document.getElementById('stores');
+  const onScreen=shown&&rows&&shown.user===user&&shown.date===data.date;
+  if(onScreen&&data.partial&&!shown.partial){
+    // Keep the complete rows on screen until the rest arrives
+    document.getElementById('cache-info').textContent=cacheStatus(data);
+    return;
+  }
+  const sameStores=onScreen&&shown.stores.length===data.stores.length&&
+    shown.stores.every((store,i)=>store.chain===data.stores[i].chain&&store.name===data.stores[i].name);
+  if(!sameStores)return renderResult(data);
+  data.stores.forEach((store,i)=>{
+    if(JSON.stringify(store)!==JSON.stringify(shown.stores[i]))rows.children[i].outerHTML=storeHtml(store);
+  });
+  document.getElementById('summary').innerHTML=summaryHtml(data.summary.open,data.summary.closed);
+  const info=document.getElementById('cache-info');
+  info.className=`cache-info ${data.cached?'cached':''}`;
+  info.textContent=cacheStatus(data);
+  shown={user,date:data.date,stores:data.stores,partial:!!data.partial};
+}
+
+function renderError(user,error){
+  if(user!==currentUser)return;
+  const info=document.getElementById('cache-info');
+  if(shown&&shown.user===user&&info){
+    info.textContent='⚠️ Osvježavanje nije uspjelo, prikazani su spremljeni podaci';
+    return;
+  }
+  document.getElementById('results').innerHTML=`<div class="error"><strong>⚠️ Greška:</strong><br>${error.message}</div>`;
+}
+
+// Without streaming, show what is known after this long and ask again for the rest
+const CHECK_BUDGET_MS=1500;
+// How many times to ask again while the server only has stale data and is refreshing it
+const STALE_POLLS=20;
+
 function loadData(){
+  const user=currentUser;
+  const saved=savedResult(user);
+  if(saved){
+    // Show the saved result at once and bring it up to date in the background
+    renderResult(saved.data,`📱 Spremljeno ${ageText(Date.now()-saved.savedAt)} (${saved.data.last_update}), provjeravam...`);
+    return loadBudgeted(user);
+  }
+  shown=null;
   document.getElementById('results').innerHTML='<div class="loading"><div class="spinner"></div>Učitavam podatke...</div>';
-  fetch(`/api/check?user=${currentUser}`)
+  if(STREAMING)return loadStream();
+  loadBudgeted(user);
+}
+
+function loadBudgeted(user,attempt=0){
+  fetch(`/api/check?user=${user}&budget_ms=${CHECK_BUDGET_MS}`)
   .then(response=>response.json())
   .then(data=>{
+    if(user!==currentUser)return;
     if(!data.success)throw new Error(data.error||'Nepoznata greška');
-    const cacheStatus=data.cached?`💾 Cached podaci (${data.last_update})`:`🔄 Osvježeno (${data.last_update})`;
-    let html=`<div class="date-banner">📅 ${data.day}, ${data.date}</div><div class="cache-info ${data.cached?'cached':''}">${cacheStatus}</div><div class="summary"><div class="summary-card open"><div class="number">${data.summary.open}</div><div class="label">RADI</div></div><div class="summary-card closed"><div class="number">${data.summary.closed}</div><div class="label">ZATVORENO</div></div></div>`;
-    data.stores.forEach(store=>{
-      const icon=store.open?'✅':'❌';
-      const statusClass=store.open?'open':'closed';
-      html+=`<div class="store"><div class="store-icon">${icon}</div><div class="store-info"><div class="store-chain">${store.chain}</div><div class="store-name">${store.name}</div><span class="store-hours ${statusClass}">${store.hours}</span></div></div>`;
+    showResult(user,data);
+    if(data.partial)setTimeout(()=>{if(user===currentUser)loadBudgeted(user);},data.retry_after_ms);
+    else if(data.stale&&attempt<STALE_POLLS)loadBudgeted(user,attempt+1);
+  })
+  .catch(error=>renderError(user,error));
+}
+
+function loadStream(){
+  const user=currentUser;
+  const rows=[];
+  let buffer='';
+  const handle=frame=>{
+    if(user!==currentUser)return;
+    if(frame.type==='start'){
+      document.getElementById('results').innerHTML=`<div class="date-banner">📅 ${frame.day}, ${frame.date}</div><div class="cache-info">Učitavam trgovine...</div><div id="stream-summary">${summaryHtml(0,0)}</div><div id="stream-stores"></div>`;
+    }else if(frame.type==='store'){
+      rows.push(frame.store);
+      const open=rows.filter(s=>s.open).length;
+      document.getElementById('stream-summary').innerHTML=summaryHtml(open,rows.length-open);
+      document.getElementById('stream-stores').insertAdjacentHTML('beforeend',storeHtml(frame.store));
+    }else if(frame.type==='done'){
+      showResult(user,frame.result);
+      if(frame.result.stale)loadBudgeted(user,1);
+    }else if(frame.type==='error'){
+      throw new Error(frame.error||'Nepoznata greška');
+    }
+  };
+  fetch(`/api/check/stream?user=${user}`)
+  .then(response=>{
+    if(!response.ok||!response.body)throw new Error(`HTTP ${response.status}`);
+    const reader=response.body.getReader();
+    const decoder=new TextDecoder();
+    const pump=()=>reader.read().then(({done,value})=>{
+      buffer+=decoder.decode(value||new Uint8Array(),{stream:!done});
+      const lines=buffer.split('\n');
+      buffer=lines.pop();
+      lines.filter(line=>line.trim()).forEach(line=>handle(JSON.parse(line)));
+      if(!done)return pump();
+      if(buffer.trim())handle(JSON.parse(buffer));
     });
-    document.getElementById('results').innerHTML=html;
+    return pump();
   })
-  .catch(error=>{
-    document.getElementById('results').innerHTML=`<div class="error"><strong>⚠️ Greška:</strong><br>${error.message}</div>`;
-  });
+  .catch(error=>renderError(user,error));
 }
 
-loadData();
+// The page already shows a cached result for this user when the server had one
+const initial = JSON.parse(document.getElementById('initial-data').textContent);
+if (initial && initial.user === currentUser) {
+  shown = {user: currentUser, date: initial.date, stores: initial.stores, partial: false};
+  saveResult(currentUser, initial);
+  // Bring it up to date in the background; for a stale one the server is already refreshing
+  loadBudgeted(currentUser);
+} else {
+  loadData();
+}